@@ -0,0 +1,619 @@
+#! /usr/bin/python3
+"""Aggregate the line protocol of gaudi_mon.py from all the servers into
+compact rollups (sum, avg and max per window, by host, rack, switch peer
+and for the whole cluster). Runs on the management server, next to
+InfluxDB"""
+
+__author__ = "Paresh Gupta"
+__version__ = "1.00"
+
+import sys
+import os
+import argparse
+import logging
+from logging.handlers import RotatingFileHandler
+import json
+import re
+import time
+import gzip
+import signal
+import threading
+import fnmatch
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gaudi_mon
+
+user_args = {}
+FILENAME_PREFIX = __file__.replace('.py', '')
+LOGFILE_LOCATION = '/var/log/telegraf/'
+LOGFILE_SIZE = 10000000
+LOGFILE_NUMBER = 5
+logger = logging.getLogger('GaudiAgg')
+
+# Rollups computed for every window. One entry per measurement:
+# (measurement, field name globs, group by). A group by is a tag, rack
+# (from -racks or -rack-re on the host tag) or cluster (all the series).
+# Series without the tag of a group by are left out of that group.
+# peer_name is a tag only with -schema full of gaudi_mon.py, with -schema
+# compact it is in GaudiIntfMeta and the peer rollups stay empty.
+ROLLUPS = (
+    ('GaudiMon', ('pwr', 'util', 'temperature', 'mem', 'un_ecc'),
+     ('host', 'rack', 'cluster')),
+    ('GaudiIntIntf', ('*err*', '*fault*'), ('host', 'rack')),
+    ('GaudiExtIntf', ('cdc', '*err*', '*fault*', '*discard*'),
+     ('host', 'rack', 'peer_name')),
+    ('GaudiIntIntfRate', ('*',), ('host', 'rack')),
+    ('GaudiExtIntfRate', ('*',), ('host', 'rack', 'peer_name')),
+)
+
+# Rollup measurement of a measurement
+ROLLUP_SUFFIX = 'Rollup'
+
+PRECISION_NS = {'n': 1, 'ns': 1, 'u': 1000, 'us': 1000, 'ms': 1000000,
+                's': 1000000000}
+
+class LineProtocolError(Exception):
+    """A line is not valid line protocol"""
+
+###############################################################################
+# BEGIN: Generic functions
+###############################################################################
+
+def parse_cmdline_arguments():
+    """Parse input arguments"""
+
+    desc_str = \
+    'Aggregate InfluxDB line protocol of gaudi_mon.py from all the servers\n' + \
+    'into rollups per window by host, rack, switch peer and cluster.\n' + \
+    'Line protocol is read from files (or stdin) or from an HTTP /write\n' + \
+    'endpoint compatible with InfluxDB 1.x'
+
+    parser = argparse.ArgumentParser(description=desc_str,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-f', dest='files', nargs='+', default=None, \
+            metavar='FILE', help='Read recorded line protocol from FILE(s), \
+            - for stdin, instead of serving /write')
+    parser.add_argument('-port', dest='port', type=int, default=8186, \
+            help='TCP port of the /write endpoint. Default: 8186')
+    parser.add_argument('-url', dest='url', default=None, \
+            help='InfluxDB URL to write the rollups to. Print them on \
+            stdout if not given')
+    parser.add_argument('-db', dest='db', default='telegraf', \
+            help='InfluxDB database. Default: telegraf')
+    parser.add_argument('-forward', dest='forward', \
+            action='store_true', default=False, help='Also write the \
+            received lines as is to -url, so that telegraf on the servers \
+            only needs to point to this endpoint')
+    parser.add_argument('-window', dest='window', type=float, default=60, \
+            help='Rollup window in seconds. Default: 60')
+    parser.add_argument('-grace', dest='grace', type=float, default=10, \
+            help='Seconds a window stays open after its end for late \
+            lines. Default: 10')
+    parser.add_argument('-racks', dest='racks', default=None, \
+            metavar='FILE', help='JSON file of {"<host>": "<rack>"}')
+    parser.add_argument('-rack-re', dest='rack_re', default=None, \
+            help='Regular expression on the host tag. Its first group is \
+            the rack, e.g. "gaudi-2-(\\d)\\d"')
+    parser.add_argument('-v', dest='verbose', \
+            action='store_true', default=False, help='warn and above')
+    parser.add_argument('-vv', dest='more_verbose', \
+            action='store_true', default=False, help='info and above')
+    parser.add_argument('-vvv', dest='most_verbose', \
+            action='store_true', default=False, help='debug and above')
+
+    args = parser.parse_args()
+    user_args['files'] = args.files
+    user_args['port'] = args.port
+    user_args['url'] = args.url
+    user_args['db'] = args.db
+    user_args['forward'] = args.forward
+    user_args['window'] = args.window
+    user_args['grace'] = args.grace
+    user_args['racks'] = args.racks
+    user_args['rack_re'] = args.rack_re
+    user_args['verbose'] = args.verbose
+    user_args['more_verbose'] = args.more_verbose
+    user_args['most_verbose'] = args.most_verbose
+
+def setup_logging():
+    """Setup logging. Messages of gaudi_mon (e.g. of InfluxWriter) go to
+    the same file"""
+    this_filename = (FILENAME_PREFIX.split('/'))[-1]
+    logfile_location = LOGFILE_LOCATION + this_filename
+    logfile_prefix = logfile_location + '/' + this_filename
+    try:
+        os.mkdir(logfile_location)
+    except FileExistsError:
+        pass
+    except Exception:
+        # Log in local directory if can't be created in LOGFILE_LOCATION
+        logfile_prefix = FILENAME_PREFIX
+    rotator = RotatingFileHandler(logfile_prefix + '.log',
+                                  maxBytes=LOGFILE_SIZE,
+                                  backupCount=LOGFILE_NUMBER)
+    rotator.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - ' \
+                                           '%(message)s'))
+    for log in (logger, gaudi_mon.logger):
+        log.addHandler(rotator)
+        if user_args['verbose']:
+            log.setLevel(logging.WARNING)
+        if user_args['more_verbose']:
+            log.setLevel(logging.INFO)
+        if user_args['most_verbose']:
+            log.setLevel(logging.DEBUG)
+
+def load_rack_map():
+    """Return {host: rack} from -racks"""
+    if user_args['racks'] is None:
+        return {}
+    with open(user_args['racks'], 'r', encoding='utf-8') as f:
+        racks = json.load(f)
+    if not isinstance(racks, dict):
+        raise ValueError(user_args['racks'] + ' is not a JSON object')
+    return {str(host): str(rack) for host, rack in racks.items()}
+
+###############################################################################
+# END: Generic functions
+###############################################################################
+
+###############################################################################
+# BEGIN: Line protocol parser
+###############################################################################
+
+def split_unescaped(text, sep, quotes=False):
+    """Split text on sep, skipping backslash escaped characters and, with
+    quotes, separators inside double quoted strings"""
+    if '\\' not in text and (not quotes or '"' not in text):
+        return text.split(sep)
+    parts = []
+    start = 0
+    i = 0
+    in_str = False
+    while i < len(text):
+        char = text[i]
+        if char == '\\':
+            i = i + 2
+            continue
+        if quotes and char == '"':
+            in_str = not in_str
+        elif char == sep and not in_str:
+            parts.append(text[start:i])
+            start = i + 1
+        i = i + 1
+    parts.append(text[start:])
+    return parts
+
+LP_UNESCAPE_RE = re.compile(r'\\(.)')
+
+def lp_unescape(text):
+    """Remove the backslash escapes of a measurement, tag or field key"""
+    if '\\' not in text:
+        return text
+    return LP_UNESCAPE_RE.sub(r'\1', text)
+
+def parse_field_value(val):
+    """Return a number, or None for strings and booleans"""
+    if val == '' or val[0] == '"':
+        return None
+    if val[-1] in ('i', 'u'):
+        val = val[:-1]
+    try:
+        return int(val)
+    except ValueError:
+        pass
+    try:
+        return float(val)
+    except ValueError:
+        return None
+
+def parse_lp_line(line, precision_ns=1):
+    """Parse one line. Return (measurement, tags, fields, ts_ns) where tags
+    is a dict and fields has only the numeric fields. Return None for an
+    empty or comment line. Raise LineProtocolError"""
+    line = line.strip()
+    if line == '' or line[0] == '#':
+        return None
+    sections = split_unescaped(line, ' ', quotes=True)
+    if len(sections) == 2:
+        key, fields_str = sections
+        ts_ns = time.time_ns()
+    elif len(sections) == 3:
+        key, fields_str, ts = sections
+        try:
+            ts_ns = int(ts) * precision_ns
+        except ValueError:
+            raise LineProtocolError('invalid timestamp: ' + ts)
+    else:
+        raise LineProtocolError('expected 2 or 3 sections: ' + line[:80])
+
+    parts = split_unescaped(key, ',')
+    measurement = lp_unescape(parts[0])
+    tags = {}
+    for part in parts[1:]:
+        tag = split_unescaped(part, '=')
+        if len(tag) != 2:
+            raise LineProtocolError('invalid tag: ' + part)
+        tags[lp_unescape(tag[0])] = lp_unescape(tag[1])
+
+    fields = {}
+    for part in split_unescaped(fields_str, ',', quotes=True):
+        field = part.split('=', 1) if '\\' not in part else \
+                split_unescaped(part, '=', quotes=True)
+        if len(field) < 2:
+            raise LineProtocolError('invalid field: ' + part)
+        val = parse_field_value('='.join(field[1:]))
+        if val is not None:
+            fields[lp_unescape(field[0])] = val
+    return measurement, tags, fields, ts_ns
+
+###############################################################################
+# END: Line protocol parser
+###############################################################################
+
+###############################################################################
+# BEGIN: Aggregation
+###############################################################################
+
+class Aggregator:
+    """Streaming rollups. The last value of every selected field of every
+    series is kept per window. When a window closes, the values are
+    summed, averaged and maxed across the series of every group"""
+
+    def __init__(self, window, grace, racks, rack_re, write):
+        self.window_ns = int(window * 1e9)
+        self.grace_ns = int(grace * 1e9)
+        self.racks = racks
+        self.rack_re = re.compile(rack_re) if rack_re else None
+        self.write = write
+        self.lock = threading.Lock()
+        # window start => {(measurement, tags tuple): (tags, {field: val})}
+        self.windows = {}
+        # Windows before this one are closed
+        self.closed_before = 0
+        self.specs = {}
+        for measurement, globs, group_bys in ROLLUPS:
+            self.specs[measurement] = (globs, group_bys)
+        # (measurement, field) => selected or not
+        self.field_cache = {}
+        self.stats = {'lines_in': 0, 'lines_bad': 0, 'lines_late': 0,
+                      'rollup_lines': 0, 'windows': 0, 'series_no_peer': 0}
+        self.warned_no_peer = False
+
+    def is_selected(self, measurement, field):
+        """True if a field is in the rollups of its measurement"""
+        key = (measurement, field)
+        selected = self.field_cache.get(key)
+        if selected is None:
+            globs = self.specs[measurement][0]
+            selected = any(fnmatch.fnmatchcase(field, glob) \
+                           for glob in globs)
+            self.field_cache[key] = selected
+        return selected
+
+    def get_rack(self, host):
+        """Rack of a host, or None"""
+        rack = self.racks.get(host)
+        if rack is None and self.rack_re is not None:
+            match = self.rack_re.search(host)
+            if match:
+                rack = match.group(1) if match.groups() else match.group(0)
+        return rack
+
+    def add_lines(self, lines, precision_ns=1):
+        """Parse and add lines of line protocol"""
+        with self.lock:
+            for line in lines:
+                try:
+                    parsed = parse_lp_line(line, precision_ns)
+                except LineProtocolError as e:
+                    self.stats['lines_bad'] = self.stats['lines_bad'] + 1
+                    logger.debug('Bad line: %s', e)
+                    continue
+                if parsed is None:
+                    continue
+                self.stats['lines_in'] = self.stats['lines_in'] + 1
+                measurement, tags, fields, ts_ns = parsed
+                if measurement not in self.specs:
+                    continue
+                start = ts_ns - ts_ns % self.window_ns
+                if start < self.closed_before:
+                    self.stats['lines_late'] = self.stats['lines_late'] + 1
+                    continue
+                series = self.windows.get(start)
+                if series is None:
+                    series = {}
+                    self.windows[start] = series
+                key = (measurement, tuple(sorted(tags.items())))
+                entry = series.get(key)
+                if entry is None:
+                    entry = (tags, {})
+                    series[key] = entry
+                for field, val in fields.items():
+                    if self.is_selected(measurement, field):
+                        entry[1][field] = val
+
+    def close_windows(self, now_ns):
+        """Close and emit the windows that ended grace before now_ns"""
+        with self.lock:
+            closing = sorted(start for start in self.windows \
+                             if start + self.window_ns + self.grace_ns <= \
+                             now_ns)
+            for start in closing:
+                self.emit_window(start, self.windows.pop(start))
+                self.closed_before = max(self.closed_before,
+                                         start + self.window_ns)
+            if closing:
+                self.emit_self_stats(now_ns)
+
+    def close_all(self):
+        """Close all the windows, e.g. at the end of the input"""
+        if self.windows:
+            self.close_windows(max(self.windows) + self.window_ns + \
+                               self.grace_ns)
+
+    def emit_window(self, start, series):
+        """Compute and write the rollups of one window"""
+        # (measurement, group by, group) => {field: [sum, count, max]}
+        groups = {}
+        # (measurement, group by, group) => number of series
+        n_series = {}
+        # Series left out of the peer rollups
+        no_peer = 0
+        for (measurement, _), (tags, fields) in series.items():
+            if not fields:
+                continue
+            for group_by in self.specs[measurement][1]:
+                if group_by == 'cluster':
+                    group = 'all'
+                elif group_by == 'rack':
+                    group = self.get_rack(tags.get('host', ''))
+                else:
+                    group = tags.get(group_by)
+                if group is None or group == '':
+                    if group_by == 'peer_name':
+                        no_peer = no_peer + 1
+                    continue
+                key = (measurement, group_by, group)
+                acc = groups.get(key)
+                if acc is None:
+                    acc = {}
+                    groups[key] = acc
+                n_series[key] = n_series.get(key, 0) + 1
+                for field, val in fields.items():
+                    agg = acc.get(field)
+                    if agg is None:
+                        acc[field] = [val, 1, val]
+                    else:
+                        agg[0] = agg[0] + val
+                        agg[1] = agg[1] + 1
+                        if val > agg[2]:
+                            agg[2] = val
+
+        ts = ' ' + str(start) + '\n'
+        for (measurement, group_by, group), acc in sorted(groups.items()):
+            fields = ['series=' + str(n_series[(measurement, group_by,
+                                                group)])]
+            for field, (total, count, peak) in sorted(acc.items()):
+                # Prefixed, pwr_max and mem_max are fields of GaudiMon
+                key = gaudi_mon.lp_escape_key(field)
+                fields.append('sum_' + key + '=' + str(total))
+                fields.append('avg_' + key + '=' + \
+                              str(round(total / count, 3)))
+                fields.append('max_' + key + '=' + str(peak))
+            tags = (('by', group_by),)
+            if group_by != 'cluster':
+                tags = tags + ((group_by, group),)
+            self.write(gaudi_mon.lp_prefix(measurement + ROLLUP_SUFFIX,
+                                           tags) + ','.join(fields) + ts)
+            self.stats['rollup_lines'] = self.stats['rollup_lines'] + 1
+        self.stats['windows'] = self.stats['windows'] + 1
+        if no_peer:
+            self.stats['series_no_peer'] = self.stats['series_no_peer'] + \
+                                           no_peer
+            if not self.warned_no_peer:
+                logger.warning('%s series without peer_name tag are left ' \
+                               'out of the peer rollups, run gaudi_mon.py ' \
+                               'with -schema full', no_peer)
+                self.warned_no_peer = True
+        logger.info('Window %s: %s series, %s rollups', start, len(series),
+                    len(groups))
+
+    def emit_self_stats(self, now_ns):
+        """Write the counters of the aggregator as GaudiAggSelf"""
+        fields = [key + '=' + str(val) for key, val in self.stats.items()]
+        fields.append('open_windows=' + str(len(self.windows)))
+        self.write(gaudi_mon.lp_prefix('GaudiAggSelf', ()) + \
+                   ','.join(fields) + ' ' + str(now_ns) + '\n')
+
+###############################################################################
+# END: Aggregation
+###############################################################################
+
+###############################################################################
+# BEGIN: Input and output
+###############################################################################
+
+# Writes go through one lock, InfluxWriter is not thread safe
+output_lock = threading.Lock()
+writer = None
+
+def write_line(line):
+    """Write one line of line protocol to InfluxDB or stdout"""
+    with output_lock:
+        if writer is not None:
+            writer.write(line)
+        else:
+            sys.stdout.write(line)
+
+def flush_output():
+    """Send or print what is buffered"""
+    with output_lock:
+        if writer is not None:
+            writer.flush()
+        else:
+            sys.stdout.flush()
+
+def get_writer():
+    """InfluxWriter of gaudi_mon for -url, or None for stdout"""
+    if user_args['url'] is None:
+        return None
+    this_filename = (FILENAME_PREFIX.split('/'))[-1]
+    return gaudi_mon.InfluxWriter(user_args['url'], user_args['db'], 5000, 5,
+                                  gaudi_mon.STATE_LOCATION + this_filename + \
+                                  '_spool/', 100 * 1000000)
+
+def read_files(aggregator):
+    """Aggregate recorded line protocol. Windows are closed as the
+    timestamps in the input move past them"""
+    for path in user_args['files']:
+        f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+        try:
+            batch = []
+            for line in f:
+                batch.append(line)
+                if len(batch) >= 10000:
+                    aggregator.add_lines(batch)
+                    close_seen_windows(aggregator)
+                    batch = []
+            aggregator.add_lines(batch)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    aggregator.close_all()
+
+def close_seen_windows(aggregator):
+    """Close the windows older than the newest one in the input"""
+    if aggregator.windows:
+        aggregator.close_windows(max(aggregator.windows))
+
+class WriteHandler(BaseHTTPRequestHandler):
+    """The subset of the InfluxDB 1.x API used by telegraf and
+    gaudi_mon.py: POST /write, GET /ping and POST /query for CREATE
+    DATABASE"""
+
+    aggregator = None
+
+    def do_GET(self):
+        """GET /ping"""
+        if self.path.split('?')[0] == '/ping':
+            self.send_response(204)
+            self.end_headers()
+            return
+        self.send_error(404)
+
+    def do_POST(self):
+        """POST /write and /query"""
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if path == '/query':
+            reply = b'{"results":[{"statement_id":0}]}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+            return
+        if path != '/write':
+            self.send_error(404)
+            return
+        params = urllib.parse.parse_qs(query)
+        precision = params.get('precision', ['n'])[0]
+        try:
+            if self.headers.get('Content-Encoding', '') == 'gzip':
+                body = gzip.decompress(body)
+            lines = body.decode('utf-8').splitlines()
+        except (OSError, UnicodeDecodeError) as e:
+            self.send_error(400, str(e))
+            return
+        self.aggregator.add_lines(lines, PRECISION_NS.get(precision, 1))
+        if user_args['forward']:
+            for line in lines:
+                if line.strip():
+                    write_line(line + '\n')
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Log requests at debug level instead of stderr"""
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+def close_loop(aggregator, stop):
+    """Close windows by wall clock and flush the output every second"""
+    while not stop.wait(1):
+        try:
+            aggregator.close_windows(time.time_ns())
+            if writer is not None:
+                with output_lock:
+                    writer.maybe_flush()
+            else:
+                flush_output()
+        except Exception as e:
+            logger.exception('Closing windows failed: %s', e)
+
+def handle_shutdown_signal(signum, frame):
+    """SIGTERM handler, leave serve_forever()"""
+    logger.warning('Got signal %s, shutting down', signum)
+    raise KeyboardInterrupt()
+
+def serve(aggregator):
+    """Serve /write until SIGTERM or SIGINT"""
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    WriteHandler.aggregator = aggregator
+    stop = threading.Event()
+    closer = threading.Thread(target=close_loop, args=(aggregator, stop),
+                              name='closer', daemon=True)
+    closer.start()
+    server = ThreadingHTTPServer(('', user_args['port']), WriteHandler)
+    server.daemon_threads = True
+    logger.warning('Serving /write on port %s', user_args['port'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    stop.set()
+    closer.join()
+
+###############################################################################
+# END: Input and output
+###############################################################################
+
+def main(argv):
+    """The beginning of the beginning"""
+    global writer
+
+    if len(argv) <= 1:
+        print('Try -h option for usage help')
+        return
+    parse_cmdline_arguments()
+    setup_logging()
+    logger.warning('---- START (version %s) ----', __version__)
+
+    try:
+        racks = load_rack_map()
+    except (OSError, ValueError) as e:
+        logger.error('Unable to load %s: %s', user_args['racks'], e)
+        print('Unable to load ' + str(user_args['racks']) + ': ' + str(e))
+        return
+
+    writer = get_writer()
+    aggregator = Aggregator(user_args['window'], user_args['grace'], racks,
+                            user_args['rack_re'], write_line)
+    try:
+        if user_args['files']:
+            read_files(aggregator)
+        else:
+            serve(aggregator)
+            aggregator.close_all()
+    except BrokenPipeError:
+        pass
+    flush_output()
+    if writer is not None:
+        writer.close()
+    logger.warning('---------- END ----------')
+
+if __name__ == '__main__':
+    main(sys.argv)
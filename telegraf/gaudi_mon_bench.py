@@ -0,0 +1,881 @@
+#! /usr/bin/python3
+"""Micro benchmarks for gaudi_mon.py. Synthetic fixtures are generated in
+the format of the real commands, so no Gaudi hardware is needed"""
+
+__author__ = "Paresh Gupta"
+__version__ = "1.00"
+
+import sys
+import os
+import argparse
+import logging
+import re
+import json
+import time
+import timeit
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gaudi_mon
+
+###############################################################################
+# BEGIN: Fixtures
+###############################################################################
+
+def make_bus_ids(n_cards):
+    """Return n_cards unique bus-ids"""
+    return ['0000:%02x:00.0' % (0x33 + i) for i in range(n_cards)]
+
+def make_hl_smi_fixture(n_cards):
+    """hl-smi summary table for n_cards"""
+    lines = [
+        '+-----------------------------------------------------------------'
+        '------------+',
+        '| HL-SMI Version:                              hl-1.17.0-fw-51.3.0'
+        '            |',
+        '| Driver Version:                                     1.17.0-28a11ca'
+        '          |',
+        '|-------------------------------+----------------------+----------'
+        '------------+',
+        '| AIP  Name       Persistence-M| Bus-Id        Disp.A | Volatile '
+        'Uncor-Events|',
+        '| Fan  Temp  Perf  Pwr:Usage/Cap|         Memory-Usage | AIP-Util  '
+        'Compute M. |',
+        '|===============================+======================+=========='
+        '============|']
+    for i, bus_id in enumerate(make_bus_ids(n_cards)):
+        lines.append('| %3d  HL-225              N/A  | %s     N/A |        '
+                     '           0  |' % (i, bus_id))
+        lines.append('| N/A   %2dC   N/A   %3dW / 600W |  %5dMiB / 98304MiB | '
+                     '  %3d%%           N/A |' % (26 + i % 50, 88 + i, 768 + i,
+                                                 i % 100))
+        lines.append('|-------------------------------+----------------------+'
+                     '----------------------+')
+    lines.extend([
+        '| Compute Processes:                                               '
+        'AIP Memory |',
+        '|  AIP       PID   Type   Process name                             '
+        'Usage      |',
+        '|================================================================='
+        '============|',
+        '|   0        N/A   N/A    N/A                                      '
+        'N/A        |',
+        '+================================================================='
+        '============+'])
+    return '\n'.join(lines)
+
+def make_host_dict(n_cards, n_ports, n_counters):
+    """Fill host_dict of gaudi_mon with a synthetic payload of n_cards, each
+    with n_ports internal and 3 external interfaces of n_counters"""
+    gaudi_dict = setup_host_dict(n_cards)
+    names = ['counter_%d' % i for i in range(n_counters)]
+    for oam_id, oam_attr in gaudi_dict.items():
+        oam_attr['stats'].update({'temperature': 30, 'util': 50, 'pwr': 300,
+                                  'pwr_max': 600, 'mem': 768,
+                                  'mem_max': 98304, 'un_ecc': 0})
+        for port in range(n_ports):
+            record = gaudi_mon.IntfRecord()
+            record.meta['oper_state'] = 'UP'
+            record.set_counters(names, [port * i for i in range(n_counters)])
+            oam_attr['intf_dict']['internal'][port] = record
+        for i in range(3):
+            record = gaudi_mon.IntfRecord()
+            record.meta.update({'intf': 'enp%ss0d%d' % (oam_id, i),
+                                'oper_state': 'up', 'oper_speed': '100000',
+                                'peer_name': 'SW L1 H 12',
+                                'peer_intf': 'Eth1/%d/1' % i})
+            record.set_counters(names, [i * j for j in range(n_counters)])
+            mac = 'b0:fd:0b:%02x:00:%02x' % (int(oam_id), i)
+            oam_attr['intf_dict']['external'][mac] = record
+    gaudi_mon.host_dict['bench']['meta'].update(
+        {'os_release': 'Ubuntu 22.04.4 LTS', 'cpu_model': 'Intel Xeon',
+         'num_cpu': 160})
+
+def make_hl_smi_q_fixture(bus_ids):
+    """hl-smi -q output for bus_ids"""
+    lines = ['================ HL-SMI LOG ================',
+             'Driver Version                          : 1.17.0-28a11ca']
+    for i, bus_id in enumerate(bus_ids):
+        lines.extend(['[%d] AIP (accel%d) %s' % (i, i, bus_id),
+                      '    Product Name                    : HL-225',
+                      '    Serial Number                   : AN%08d' % i,
+                      '    Bus Id                          : %s' % bus_id,
+                      '    Module status                   : Active',
+                      '    [0] soc                         : 1800 MHz'])
+    return '\n'.join(lines) + '\n'
+
+HL_SMI_QUERY_SAMPLE = {
+    'temperature.aip': '%d C', 'utilization.aip': '%d %%',
+    'power.draw': '%d W', 'power.max': '600 W', 'memory.used': '%d MiB',
+    'memory.total': '98304 MiB', 'ecc.errors.uncorrected.volatile.total': '0',
+    'driver_version': '1.17.0-28a11ca', 'name': 'HL-225',
+    'serial': 'AN%08d', 'clocks.current.soc': '1800 MHz'}
+
+def make_hl_smi_query_fixture(bus_ids, collectors):
+    """hl-smi -Q command and its CSV output for the fields of collectors"""
+    fields = [field for field in gaudi_mon.HL_SMI_QUERY_FIELDS \
+              if field[2] is None or field[2] in collectors]
+    lines = []
+    for i, bus_id in enumerate(bus_ids):
+        row = [bus_id]
+        for field in fields[1:]:
+            sample = HL_SMI_QUERY_SAMPLE[field[1]]
+            row.append(sample % i if '%d' in sample or '%08d' in sample \
+                       else sample)
+        lines.append(', '.join(row))
+    cmd = 'hl-smi -Q ' + ','.join(field[1] for field in fields) + \
+          ' -f csv,noheader'
+    return cmd, '\n'.join(lines)
+
+def make_hl_smi_link_fixture(n_ports):
+    """hl-smi -n link output of one card"""
+    return '\n'.join('port %d:\tUP' % port for port in range(n_ports))
+
+# Counter names of a Gaudi2 port, repeated with a suffix for more counters
+NIC_COUNTER_NAMES = (
+    'OctetsReceivedOK', 'OctetsTransmittedOK', 'aFramesReceivedOK',
+    'aFramesTransmittedOK', 'aFrameCheckSequenceErrors', 'aAlignmentErrors',
+    'aPAUSEMACCtrlFramesReceived', 'aPAUSEMACCtrlFramesTransmitted',
+    'ifInErrors', 'ifOutErrors', 'ifInUcastPkts', 'ifOutUcastPkts',
+    'ifInMulticastPkts', 'ifOutMulticastPkts', 'ifInBroadcastPkts',
+    'ifOutBroadcastPkts', 'etherStatsDropEvents', 'etherStatsUndersizePkts',
+    'etherStatsOversizePkts', 'etherStatsFragments', 'etherStatsJabbers',
+    'etherStatsCRCAlignErrors', 'pcs_local_faults', 'pcs_remote_faults',
+    'pcs_remote_fault_reconfig', 'pcs_link_restores', 'pcs_link_toggles',
+    'correctable_errors', 'uncorrectable_errors', 'pre FEC SER exp (negative)',
+    'pre FEC SER int', 'post FEC SER exp (negative)', 'post FEC SER int',
+    'spmu_req_out_of_range_psn', 'spmu_res_out_of_range_psn',
+    'spmu_res_out_of_sequence_psn', 'spmu_req_out_of_sequence_psn',
+    'Congestion Q err', 'rx_pause_frames', 'tx_pause_frames',
+    'rx_buffer_overruns', 'tx_timeouts', 'qp_created', 'qp_destroyed',
+    'retransmitted_packets', 'retransmitted_bytes', 'rx_bytes', 'tx_bytes',
+    'rx_packets', 'tx_packets', 'rx_drops', 'tx_drops', 'cw_corrected_accum',
+    'cw_uncorrect_accum', 'symbol_errors', 'link_training_attempts',
+    'tx_fifo_underflow', 'rx_fifo_overflow', 'temperature', 'latency_avg')
+
+def make_counter_names(n_counters, realistic=False):
+    """Names of n_counters counters, counter_<i> or realistic NIC names"""
+    if not realistic:
+        return ['counter_%d' % i for i in range(n_counters)]
+    n_base = len(NIC_COUNTER_NAMES)
+    return [NIC_COUNTER_NAMES[i % n_base] + \
+            ('' if i < n_base else '_%d' % (i // n_base)) \
+            for i in range(n_counters)]
+
+def make_hl_smi_stats_fixture(n_ports, n_counters, realistic=False):
+    """hl-smi -n stats output of one card"""
+    names = make_counter_names(n_counters, realistic)
+    lines = []
+    for port in range(n_ports):
+        lines.append('port %d:' % port)
+        for i, name in enumerate(names):
+            lines.append('\t%s: %d' % (name, port * 100000 + i))
+        lines.append('\tetherStatsOctets: 5')
+    return '\n'.join(lines)
+
+def make_lldp_fixture(i):
+    """sudo lldptool -t -n output of one interface"""
+    return '\n'.join(['Chassis ID TLV', '\tMAC: 00:11:22:33:44:55',
+                      'Port ID TLV', '\tIfname: Eth1/%d/1' % (i + 1),
+                      'System Name TLV', '\tSW-L1-H12',
+                      'System capabilities TLV',
+                      '\tSystem capabilities: Bridge, Router',
+                      'Management Address TLV', '\tIPv4: 10.0.0.1'])
+
+def make_fixture_bundle(n_cards, n_ports, n_counters, n_ext=3,
+                        realistic=False):
+    """-replay fixture of a synthetic host with n_cards, each with n_ports
+    internal and n_ext external interfaces of n_counters, named counter_<i>
+    or like the counters of a real port with realistic"""
+    pcie = gaudi_mon.PCIE_STR
+    bus_ids = make_bus_ids(n_cards)
+    cmds = {}
+    files = {'/etc/hostname': 'bench\n'}
+    dirs = {pcie: bus_ids + ['bind', 'module', 'new_id', 'unbind']}
+    ethtool = {}
+
+    def cmd(name, stdout):
+        cmds[name] = {'returncode': 0, 'stdout': stdout, 'stderr': '',
+                      'duration': 0, 'timed_out': False}
+
+    cmd('hl-smi', make_hl_smi_fixture(n_cards))
+    cmd('hl-smi -q', make_hl_smi_q_fixture(bus_ids))
+    for collectors in (('s',), ('m',), ('s', 'm')):
+        cmd(*make_hl_smi_query_fixture(bus_ids, collectors))
+    files['/etc/os-release'] = 'NAME="Ubuntu"\n' \
+                               'PRETTY_NAME="Ubuntu 22.04.4 LTS"\n'
+    files['/proc/cpuinfo'] = 'processor\t: 0\n' \
+                             'model name\t: Intel(R) Xeon(R) Platinum\n'
+    link = make_hl_smi_link_fixture(n_ports)
+    stats = make_hl_smi_stats_fixture(n_ports, n_counters, realistic)
+    names = make_counter_names(n_counters, realistic)
+    for i, bus_id in enumerate(bus_ids):
+        card = pcie + bus_id + '/'
+        dirs[card + 'accel/'] = ['accel%d' % i]
+        files[card + 'accel/accel%d/module_id' % i] = '%d\n' % i
+        files[card + 'accel/accel%d/device_type' % i] = 'GAUDI2\n'
+        files[card + 'accel/accel%d/status' % i] = 'operational\n'
+        cmd('hl-smi -n link -i ' + bus_id, link)
+        cmd('hl-smi -n stats -i ' + bus_id, stats)
+        intf_names = ['enp%ds0d%d' % (i, j) for j in range(n_ext)]
+        dirs[card + 'net/'] = intf_names
+        for j, intf_name in enumerate(intf_names):
+            intf = card + 'net/' + intf_name + '/'
+            files[intf + 'address'] = 'b0:fd:0b:%02x:%02x:%02x\n' % \
+                                      (i // 256, i % 256, j)
+            files[intf + 'operstate'] = 'up\n'
+            files[intf + 'speed'] = '200000\n'
+            files[intf + 'carrier_down_count'] = '3\n'
+            files[intf + 'carrier_up_count'] = '4\n'
+            ethtool[intf_name] = {'names': names,
+                                  'values': [i * j + k for k in \
+                                             range(n_counters)]}
+            cmd('sudo lldptool -t -n -i ' + intf_name, make_lldp_fixture(j))
+    return {'version': gaudi_mon.HostIOFixture.VERSION, 'cmds': cmds,
+            'files': files, 'dirs': dirs, 'mtimes': {pcie: 1},
+            'ethtool': ethtool}
+
+###############################################################################
+# END: Fixtures
+###############################################################################
+
+###############################################################################
+# BEGIN: Reference implementations
+###############################################################################
+
+def legacy_parse_hl_smi(result, gaudi_dict):
+    """hl-smi table parsing of gaudi_mon.py version 1.00, kept as the
+    baseline"""
+    sub_result = result[result.find('Compute M'): \
+                        result.find('Compute Processes')]
+    section_list = sub_result.split('-------------------------------')
+    for section in section_list:
+        bus_id = ''.join(re.findall(r'0000:.*00\.0', section, re.IGNORECASE))
+        temperature = ''.join(re.findall(r'(\d+)C', section, re.IGNORECASE))
+        util = ''.join(re.findall(r'(\d+)%', section, re.IGNORECASE))
+        pwr = ''.join(re.findall(r'(\d+)W /', section, re.IGNORECASE))
+        pwr_max = ''.join(re.findall(r'/ (\d+)W \|', section, re.IGNORECASE))
+        mem = ''.join(re.findall(r'(\d+)MiB /', section, re.IGNORECASE))
+        mem_max = ''.join(re.findall(r'/ (\d+)MiB \|', section, \
+                          re.IGNORECASE))
+        un_ecc = ''.join(re.findall(r'\|[ ]{1,}(\d+)  \|\n\|', section, \
+                         re.IGNORECASE))
+        if temperature != '' and int(temperature) > 300:
+            continue
+        for oam_id, oam_attr in gaudi_dict.items():
+            if bus_id == oam_attr['bus_id']:
+                stats_dict = oam_attr['stats']
+                stats_dict['temperature'] = temperature
+                stats_dict['util'] = util
+                stats_dict['pwr'] = pwr
+                stats_dict['pwr_max'] = pwr_max
+                stats_dict['mem'] = mem
+                stats_dict['mem_max'] = mem_max
+                stats_dict['un_ecc'] = un_ecc
+                break
+
+def legacy_influxdb_lp(host_dict):
+    """Line protocol encoding of gaudi_mon.py version 1.00, kept as the
+    baseline. host_dict is in the dict output shape"""
+    gaudi_str = ''
+    ii_str = ''
+    ei_str = ''
+    for hostname, host_attr in host_dict.items():
+        host_tags = ',host=' + hostname
+        host_meta_str = ''
+        for key, val in host_attr['meta'].items():
+            if str(val) == '':
+                continue
+            if key in ('cpu_model', 'os_release'):
+                host_meta_str = host_meta_str + ',' + key + '="' + str(val) + \
+                                '"'
+            else:
+                host_meta_str = host_meta_str + ',' + key + '=' + str(val)
+        for oam_id, oam_attr in host_attr['gaudi2'].items():
+            gaudi_fields = ''
+            gaudi_tags = ',oam_id=' + str(oam_id) + ',bus_id=' + \
+                         str(oam_attr['bus_id'])
+            for key, val in oam_attr['stats'].items():
+                sep = ' ' if gaudi_fields == '' else ','
+                gaudi_fields = gaudi_fields + sep + key + '=' + str(val)
+            if gaudi_fields != '':
+                gaudi_str = gaudi_str + 'GaudiMon' + host_tags + gaudi_tags + \
+                            gaudi_fields + host_meta_str + '\n'
+            for port, port_attr in oam_attr['intf_dict']['internal'].items():
+                ii_fields = ''
+                ii_tags = ',bus_id=' + str(oam_attr['bus_id']) + \
+                          ',oam_id=' + str(oam_id) + ',intf=' + str(port)
+                for key, val in port_attr['meta'].items():
+                    ii_tags = ii_tags + ',' + key + '=' + val
+                for key, val in port_attr['stats'].items():
+                    sep = ' ' if ii_fields == '' else ','
+                    if str(val) == '':
+                        continue
+                    ii_fields = ii_fields + sep + key + '=' + str(val)
+                ii_str = ii_str + 'GaudiIntIntf' + ii_tags + ii_fields + '\n'
+            for mac, intf_attr in oam_attr['intf_dict']['external'].items():
+                ei_fields = ''
+                ei_tags = ',bus_id=' + str(oam_attr['bus_id']) + \
+                          ',oam_id=' + str(oam_id)
+                for key, val in intf_attr['meta'].items():
+                    ei_tags = ei_tags + ',' + key + '=' + val
+                for key, val in intf_attr['stats'].items():
+                    sep = ' ' if ei_fields == '' else ','
+                    if str(val) == '':
+                        continue
+                    ei_fields = ei_fields + sep + key + '=' + str(val)
+                ei_str = ei_str + 'GaudiExtIntf' + ei_tags + ei_fields + \
+                         ',mac="' + mac + '"\n'
+    return gaudi_str + ii_str + ei_str
+
+def legacy_parse_internal_stats(s_result, counter_filter):
+    """hl-smi -n stats parsing on the whole stripped output of the command,
+    before the output was parsed while the command runs. Kept as the
+    baseline. Return {port: (names, values)}"""
+    ports = {}
+    names = None
+    values = None
+    for line in s_result.splitlines():
+        if 'port' in line:
+            s_port = int(''.join(re.findall(r'\d+', line, re.IGNORECASE)))
+            names = []
+            values = []
+            ports[s_port] = (names, values)
+            continue
+        if ':' in line and names is not None:
+            k, v = line.split(':')
+            k = counter_filter.select(k)
+            if k is None:
+                continue
+            names.append(k)
+            values.append(int(v.strip()))
+    return ports
+
+###############################################################################
+# END: Reference implementations
+###############################################################################
+
+###############################################################################
+# BEGIN: Benchmarks
+###############################################################################
+
+def setup_host_dict(n_cards):
+    """Build host_dict in gaudi_mon for n_cards"""
+    gaudi_mon.HOSTNAME = 'bench'
+    oam_map = {}
+    for i, bus_id in enumerate(make_bus_ids(n_cards)):
+        oam_map[str(i)] = bus_id
+    gaudi_mon.build_host_dict(oam_map)
+    return gaudi_mon.host_dict['bench'][gaudi_mon.GAUDI_KEY]
+
+def report(name, seconds, number):
+    """Print one result line"""
+    print('%-40s %10.1f us/cycle' % (name, seconds / number * 1e6))
+
+def bench_hl_smi(args):
+    """Per-cycle cost of parsing the hl-smi table, before and after"""
+    for n_cards in args.cards:
+        fixture = make_hl_smi_fixture(n_cards)
+        gaudi_dict = setup_host_dict(n_cards)
+
+        def new_parse():
+            bus_id_to_oam = {}
+            for oam_attr in gaudi_dict.values():
+                bus_id_to_oam[oam_attr['bus_id']] = oam_attr
+            for bus_id, stats in gaudi_mon.parse_hl_smi_table(fixture):
+                bus_id_to_oam[bus_id]['stats'].update(stats)
+
+        report('hl-smi legacy, %d cards' % n_cards, \
+               timeit.timeit(lambda: legacy_parse_hl_smi(fixture, gaudi_dict),
+                             number=args.number), args.number)
+        report('hl-smi single pass, %d cards' % n_cards, \
+               timeit.timeit(new_parse, number=args.number), args.number)
+
+        cmd, csv_fixture = make_hl_smi_query_fixture(make_bus_ids(n_cards),
+                                                     ('s',))
+        fields = [field for field in gaudi_mon.HL_SMI_QUERY_FIELDS \
+                  if field[2] in (None, 's')]
+        report('hl-smi -Q csv, %d cards' % n_cards, \
+               timeit.timeit(lambda: gaudi_mon.parse_hl_smi_query( \
+                   csv_fixture, fields), number=args.number), args.number)
+
+def bench_lp(args):
+    """Line protocol encoding of a synthetic payload, before and after"""
+    import io
+    import json
+    make_host_dict(args.cards[0], args.ports, args.counters)
+    dict_shape = json.loads(json.dumps(gaudi_mon.host_dict,
+                                       default=gaudi_mon.host_dict_encoder))
+    number = max(1, args.number // 100)
+
+    def new_encode():
+        out = io.StringIO()
+        gaudi_mon.write_influxdb_lp(out.write)
+        return out.getvalue()
+
+    payload = new_encode()
+    print('Payload: %d cards x %d ports x %d counters, %d lines, %d bytes' % \
+          (args.cards[0], args.ports, args.counters, payload.count('\n'),
+           len(payload)))
+    report('line protocol legacy', \
+           timeit.timeit(lambda: legacy_influxdb_lp(dict_shape),
+                         number=number), number)
+    report('line protocol streaming encoder', \
+           timeit.timeit(new_encode, number=number), number)
+
+def setup_replay(bundle, argv):
+    """Point gaudi_mon at a -replay fixture with the options in argv and
+    discover the topology"""
+    with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                     delete=False) as f:
+        json.dump(bundle, f)
+    saved_argv = sys.argv
+    sys.argv = ['gaudi_mon.py'] + argv + ['-replay', f.name, 'influxdb-lp']
+    try:
+        gaudi_mon.user_args.clear()
+        gaudi_mon.parse_cmdline_arguments()
+        gaudi_mon.setup_io_fixture()
+    finally:
+        sys.argv = saved_argv
+        os.remove(f.name)
+    gaudi_mon.host_dict.clear()
+    gaudi_mon.self_stats.clear()
+    gaudi_mon.counter_state.clear()
+    gaudi_mon.lldp_cache.clear()
+    gaudi_mon.counter_filters.clear()
+    gaudi_mon.hl_smi_query_state.update(supported=True, cycle=None,
+                                        loaded=False)
+    gaudi_mon.get_gaudi_module_id_and_bus_id()
+
+def run_replay_cycle():
+    """One collection cycle of the selected collectors, encoded in line
+    protocol. Return the output"""
+    import io
+    gaudi_mon.reset_host_dict()
+    gaudi_mon.collect_data()
+    out = io.StringIO()
+    gaudi_mon.write_influxdb_lp(out.write)
+    return out.getvalue()
+
+def measure(func, number):
+    """Return (seconds per call, peak bytes allocated by one call, result
+    of the last call)"""
+    result = func()
+    start = time.perf_counter()
+    for _ in range(number):
+        result = func()
+    seconds = (time.perf_counter() - start) / number
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+def bench_collectors(args):
+    """Cycle latency, peak allocations and output size of every collector
+    and of the line protocol encoder, replayed from synthetic fixtures"""
+    number = max(1, args.number // 100)
+    print('%-6s %5s %5s %8s %12s %12s %12s' % ('', 'cards', 'ports',
+          'counters', 'ms/cycle', 'peak KB', 'output KB'))
+    for n_cards in args.cards:
+        for n_ports in args.ports:
+            for n_counters in args.counters:
+                bundle = make_fixture_bundle(n_cards, n_ports, n_counters)
+                for collector in ('-s', '-m', '-iis', '-eis'):
+                    setup_replay(bundle, [collector])
+                    seconds, peak, output = measure(run_replay_cycle,
+                                                    number)
+                    print('%-6s %5d %5d %8d %12.2f %12.1f %12.1f' % \
+                          (collector, n_cards, n_ports, n_counters,
+                           seconds * 1000, peak / 1024, len(output) / 1024))
+
+                import io
+                def encode():
+                    out = io.StringIO()
+                    gaudi_mon.write_influxdb_lp(out.write)
+                    return out.getvalue()
+                # Encoder alone on the payload of all the collectors
+                setup_replay(bundle, ['-s', '-m', '-iis', '-eis'])
+                gaudi_mon.collect_data()
+                seconds, peak, output = measure(encode, number)
+                print('%-6s %5d %5d %8d %12.2f %12.1f %12.1f' % \
+                      ('lp', n_cards, n_ports, n_counters, seconds * 1000,
+                       peak / 1024, len(output) / 1024))
+
+def bench_counters(args):
+    """Cycle latency and output of -iis and -eis with every -counters
+    profile, replayed from a fixture of realistic counter names"""
+    number = max(1, args.number // 100)
+    bundle = make_fixture_bundle(args.cards[0], args.ports, args.counters,
+                                 realistic=True)
+    print('%-6s %-12s %8s %12s %12s %12s' % ('', 'profile', 'fields',
+          'ms/cycle', 'peak KB', 'output KB'))
+    for collector in ('-iis', '-eis'):
+        for profile in gaudi_mon.COUNTER_PROFILES:
+            setup_replay(bundle, [collector, '-counters', profile])
+            seconds, peak, output = measure(run_replay_cycle, number)
+            n_fields = sum(line.split(' ')[1].count(',') + 1 \
+                           for line in output.splitlines() \
+                           if line.startswith(('GaudiIntIntf ',
+                                               'GaudiIntIntf,',
+                                               'GaudiExtIntf ',
+                                               'GaudiExtIntf,')))
+            print('%-6s %-12s %8d %12.2f %12.1f %12.1f' % \
+                  (collector, profile, n_fields, seconds * 1000,
+                   peak / 1024, len(output) / 1024))
+
+def bench_stream(args):
+    """hl-smi -n stats output of growing size read by a real command, parsed
+    after the command exits or line by line while it runs"""
+    number = max(1, args.number // 100)
+    # Never record or replay the commands of this benchmark
+    gaudi_mon.io_fixture = None
+    counter_filter = gaudi_mon.CounterFilter(
+        deny=gaudi_mon.ETHER_STATS_DUPLICATES)
+    print('%6s %8s %10s %-10s %12s %12s' % ('ports', 'counters',
+          'output KB', 'parsing', 'ms/run', 'peak KB'))
+    for n_ports in args.ports:
+        stats = make_hl_smi_stats_fixture(n_ports, args.counters, True)
+        with tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                         delete=False) as f:
+            f.write(stats)
+        cmd = 'cat ' + f.name
+
+        def buffered():
+            result = gaudi_mon.run_cmds([cmd])[0]
+            return legacy_parse_internal_stats(result.output(),
+                                               counter_filter)
+
+        def streaming():
+            parser = gaudi_mon.InternalStatsParser(counter_filter)
+            gaudi_mon.run_cmds([cmd], parsers=[parser])
+            return parser.ports
+
+        try:
+            expected = None
+            for name, func in (('buffered', buffered),
+                               ('streaming', streaming)):
+                seconds, peak, ports = measure(func, number)
+                if expected is None:
+                    expected = ports
+                elif ports != expected:
+                    print('Mismatch of ' + name + ' parsing')
+                print('%6d %8d %10.1f %-10s %12.2f %12.1f' % \
+                      (n_ports, args.counters, len(stats) / 1024, name,
+                       seconds * 1000, peak / 1024))
+        finally:
+            os.remove(f.name)
+
+# Measurement and tag set of a line, up to the first unescaped space
+LP_SERIES_RE = re.compile(r'(?:[^ \\]|\\.)*')
+
+def get_series(payload):
+    """Return the list of series keys of the lines of a payload"""
+    return [LP_SERIES_RE.match(line).group(0) \
+            for line in payload.splitlines() if line]
+
+def churn_host_dict(cycle):
+    """Flap one internal and one external port of every card and re-cable
+    one external port every 10 cycles, like a busy fabric"""
+    for oam_attr in gaudi_mon.host_dict['bench'][gaudi_mon.GAUDI_KEY].values():
+        internal = list(oam_attr['intf_dict']['internal'].values())
+        if internal:
+            record = internal[cycle % len(internal)]
+            record.meta['oper_state'] = 'DOWN' \
+                if record.meta.get('oper_state') == 'UP' else 'UP'
+        external = list(oam_attr['intf_dict']['external'].values())
+        if external:
+            record = external[cycle % len(external)]
+            record.meta['oper_state'] = 'down' \
+                if record.meta.get('oper_state') == 'up' else 'up'
+            if cycle % 10 == 0:
+                record.meta['peer_intf'] = 'Eth1/%d/1' % (cycle // 10 + 1)
+
+def bench_cardinality(args):
+    """Series written per cycle and in total over a number of cycles with
+    link flaps and re-cabling, with -schema full and compact"""
+    import io
+    print('%-8s %5s %5s %12s %14s %14s %12s' % ('schema', 'cards', 'ports',
+          'lines/cycle', 'series/cycle', 'series total', 'KB/cycle'))
+    for n_cards in args.cards:
+        bundle = make_fixture_bundle(n_cards, args.ports, args.counters)
+        for schema in ('full', 'compact'):
+            setup_replay(bundle, ['-iis', '-eis', '-schema', schema])
+            gaudi_mon.intf_meta_state.clear()
+            gaudi_mon.intf_meta_state_info['loaded'] = False
+            gaudi_mon.reset_host_dict()
+            gaudi_mon.collect_data()
+            total = set()
+            n_lines = 0
+            n_series = 0
+            n_bytes = 0
+            for cycle in range(args.cycles):
+                churn_host_dict(cycle)
+                out = io.StringIO()
+                gaudi_mon.write_influxdb_lp(out.write, self_entries=[])
+                payload = out.getvalue()
+                series = get_series(payload)
+                total.update(series)
+                n_lines = n_lines + len(series)
+                n_series = n_series + len(set(series))
+                n_bytes = n_bytes + len(payload)
+            print('%-8s %5d %5d %12.1f %14.1f %14d %12.1f' % \
+                  (schema, n_cards, args.ports, n_lines / args.cycles,
+                   n_series / args.cycles, len(total),
+                   n_bytes / args.cycles / 1024))
+
+def shm_reader(path, seconds, queue):
+    """Read the snapshot in a loop. Every stat of every card of one snapshot
+    has the same value, anything else is a torn read"""
+    reader = gaudi_mon.ShmSnapshotReader(path)
+    reads = 0
+    torn = 0
+    busy = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        try:
+            snapshot = reader.read()
+        except gaudi_mon.ShmSnapshotBusy:
+            busy = busy + 1
+            continue
+        reads = reads + 1
+        values = set()
+        for card in snapshot['cards'].values():
+            values.update(val for key, val in card.items() if key != 'bus_id')
+        if len(values) > 1:
+            torn = torn + 1
+    queue.put((reads, reader.retries, torn, busy))
+
+# Modules that a one-shot -s run must not import. subprocess is not in the
+# list, it runs hl-smi on a real host.
+SLOW_IMPORTS = ('asyncio', 'concurrent.futures', 'gzip', 'http.client',
+                'http.server', 'logging.handlers', 'random', 'socket', 'ssl')
+
+def time_command(cmd, runs, cwd):
+    """Return (median, min) seconds of runs of cmd"""
+    import subprocess
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, cwd=cwd, check=False)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[0]
+
+# Default budget in ms of python3 -m gaudi_mon -s above a bare python3
+STARTUP_BUDGET = 60
+
+def measure_startup(n_cards, runs):
+    """Replay a one-shot -s run, as the exec input runs it every 5s. Return
+    ({module: self us} of -m gaudi_mon under -X importtime,
+    {command: (median, min) seconds}) for a bare python3, the script and -m
+    gaudi_mon"""
+    import subprocess
+    bundle = make_fixture_bundle(n_cards, 1, 1)
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(bundle, f)
+    script = os.path.abspath(gaudi_mon.__file__)
+    # -m finds gaudi_mon in the current directory
+    cwd = os.path.dirname(script)
+    run_args = ['-s', '-replay', f.name, 'influxdb-lp']
+    try:
+        # Fill the bytecode cache of -m gaudi_mon
+        subprocess.run([sys.executable, '-m', 'gaudi_mon'] + run_args,
+                       stdout=subprocess.DEVNULL, cwd=cwd, check=False)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-m',
+                                 'gaudi_mon'] + run_args,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, cwd=cwd, check=False)
+        imports = {}
+        for line in result.stderr.decode('utf-8', 'replace').splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, _, name = line[len('import time:'):].split('|')
+            imports[name.strip()] = int(self_us)
+        times = {}
+        for name, cmd in (('python3 -c pass', [sys.executable, '-c',
+                                               'pass']),
+                          ('python3 gaudi_mon.py -s', [sys.executable,
+                                                       script] + run_args),
+                          ('python3 -m gaudi_mon -s', [sys.executable, '-m',
+                                                       'gaudi_mon'] + \
+                                                      run_args)):
+            times[name] = time_command(cmd, runs, cwd)
+    finally:
+        os.remove(f.name)
+    return imports, times
+
+def get_startup_overhead(times):
+    """ms of python3 -m gaudi_mon -s above a bare python3. The fastest runs
+    are compared, other processes only ever make a run slower"""
+    return (times['python3 -m gaudi_mon -s'][1] - \
+            times['python3 -c pass'][1]) * 1000
+
+def check_startup(imports, times, budget):
+    """Return the failures of a one-shot -s run measured by
+    measure_startup(): slow modules imported, or -m gaudi_mon over budget
+    ms above a bare python3"""
+    failures = []
+    slow = [name for name in SLOW_IMPORTS if name in imports]
+    if slow:
+        failures.append('one-shot -s imports ' + ', '.join(slow))
+    over = get_startup_overhead(times)
+    if over > budget:
+        failures.append('-m gaudi_mon -s takes %.1f ms over python3, '
+                        'budget is %.1f ms' % (over, budget))
+    return failures
+
+def bench_startup(args):
+    """Imports and wall time of a one-shot -s run replayed from a fixture.
+    Return False if the time above a bare interpreter is over the budget or
+    a slow module is imported"""
+    imports, times = measure_startup(args.cards[0], args.runs)
+    print('%d modules imported, %.1f ms' % \
+          (len(imports), sum(imports.values()) / 1000))
+    for name, self_us in sorted(imports.items(), key=lambda i: i[1],
+                                reverse=True)[:8]:
+        print('  %-30s %8.1f ms' % (name, self_us / 1000))
+    print('%-36s %12s %12s' % ('', 'median ms', 'min ms'))
+    for name, (median, fastest) in times.items():
+        print('%-36s %12.1f %12.1f' % (name, median * 1000, fastest * 1000))
+
+    failures = check_startup(imports, times, args.budget)
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        return False
+    print('PASS: %.1f ms over python3, budget is %.1f ms' % \
+          (get_startup_overhead(times), args.budget))
+    return True
+
+def bench_shm(args):
+    """Concurrent readers of the -shm snapshot while it is updated every
+    -w seconds"""
+    import multiprocessing
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    bus_ids = make_bus_ids(min(args.cards[0], gaudi_mon.SHM_MAX_CARDS))
+    print('%-8s %14s %14s %10s %8s %8s %10s' % ('readers', 'reads/s',
+          'reads/s/reader', 'retries', 'busy', 'torn', 'writes/s'))
+    for n_readers in args.readers:
+        fd, path = tempfile.mkstemp(prefix='gaudi_mon_bench_', dir=shm_dir)
+        os.close(fd)
+        os.remove(path)
+        writer = gaudi_mon.ShmSnapshotWriter(path)
+        writer.publish([], time.time_ns())
+        queue = multiprocessing.Queue()
+        readers = [multiprocessing.Process(target=shm_reader,
+                                           args=(path, args.seconds, queue)) \
+                   for _ in range(n_readers)]
+        for reader in readers:
+            reader.start()
+        writes = 0
+        end = time.perf_counter() + args.seconds
+        while time.perf_counter() < end:
+            stats = dict.fromkeys(gaudi_mon.SHM_FIELDS, writes % 1000)
+            writer.publish([(str(i), bus_id, stats) \
+                            for i, bus_id in enumerate(bus_ids)],
+                           time.time_ns())
+            writes = writes + 1
+            if args.period > 0:
+                time.sleep(args.period)
+        results = [queue.get(timeout=args.seconds + 60) for _ in readers]
+        for reader in readers:
+            reader.join()
+        writer.close()
+        os.remove(path)
+        reads = sum(result[0] for result in results)
+        print('%-8d %14.0f %14.0f %10d %8d %8d %10.0f' % \
+              (n_readers, reads / args.seconds,
+               reads / n_readers / args.seconds,
+               sum(result[1] for result in results),
+               sum(result[3] for result in results),
+               sum(result[2] for result in results),
+               writes / args.seconds))
+
+###############################################################################
+# END: Benchmarks
+###############################################################################
+
+def main():
+    """Run the selected benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', dest='number', type=int, default=1000, \
+            help='Iterations per measurement. Default: 1000')
+    parser.add_argument('-c', dest='cards', default=[8, 16, 64], \
+            type=lambda val: [int(i) for i in val.split(',')], \
+            help='Comma separated number of cards. Default: 8,16,64')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    sub.add_parser('hl-smi', help='hl-smi table parsing (-s)').\
+        set_defaults(func=bench_hl_smi)
+    lp_parser = sub.add_parser('lp', help='InfluxDB line protocol encoder')
+    lp_parser.add_argument('-p', dest='ports', type=int, default=24, \
+            help='Internal ports per card. Default: 24')
+    lp_parser.add_argument('-k', dest='counters', type=int, default=200, \
+            help='Counters per port. Default: 200')
+    lp_parser.set_defaults(func=bench_lp)
+    collectors_parser = sub.add_parser('collectors', help='-s, -m, -iis, \
+            -eis and the line protocol encoder, replayed from synthetic \
+            -replay fixtures')
+    collectors_parser.add_argument('-p', dest='ports', default=[24, 48], \
+            type=lambda val: [int(i) for i in val.split(',')], \
+            help='Comma separated internal ports per card. Default: 24,48')
+    collectors_parser.add_argument('-k', dest='counters', default=[60, 200], \
+            type=lambda val: [int(i) for i in val.split(',')], \
+            help='Comma separated counters per port. Default: 60,200')
+    collectors_parser.set_defaults(func=bench_collectors)
+    counters_parser = sub.add_parser('counters', help='-iis and -eis \
+            with every -counters profile, on realistic counter names')
+    counters_parser.add_argument('-p', dest='ports', type=int, default=24, \
+            help='Internal ports per card. Default: 24')
+    counters_parser.add_argument('-k', dest='counters', type=int, \
+            default=200, help='Counters per port. Default: 200')
+    counters_parser.set_defaults(func=bench_counters)
+    stream_parser = sub.add_parser('stream', help='hl-smi -n stats parsed \
+            after the command exits or while it runs, from a real command')
+    stream_parser.add_argument('-p', dest='ports', default=[24, 96, 384], \
+            type=lambda val: [int(i) for i in val.split(',')], \
+            help='Comma separated ports in the output. Default: 24,96,384')
+    stream_parser.add_argument('-k', dest='counters', type=int, \
+            default=200, help='Counters per port. Default: 200')
+    stream_parser.set_defaults(func=bench_stream)
+    cardinality_parser = sub.add_parser('cardinality', help='Series \
+            written by -iis and -eis with -schema full and compact, with \
+            link flaps and re-cabling between cycles')
+    cardinality_parser.add_argument('-p', dest='ports', type=int, \
+            default=24, help='Internal ports per card. Default: 24')
+    cardinality_parser.add_argument('-k', dest='counters', type=int, \
+            default=60, help='Counters per port. Default: 60')
+    cardinality_parser.add_argument('-cycles', dest='cycles', type=int, \
+            default=100, help='Collection cycles. Default: 100')
+    cardinality_parser.set_defaults(func=bench_cardinality)
+    startup_parser = sub.add_parser('startup', help='Imports and wall time \
+            of a one-shot -s run, with a budget. Exit status is 1 over the \
+            budget')
+    startup_parser.add_argument('-runs', dest='runs', type=int, default=20, \
+            help='Runs per measurement. Default: 20')
+    startup_parser.add_argument('-budget', dest='budget', type=float, \
+            default=STARTUP_BUDGET, help='ms of the fastest python3 -m \
+            gaudi_mon -s above the fastest bare python3. Default: 60')
+    startup_parser.set_defaults(func=bench_startup)
+    shm_parser = sub.add_parser('shm', help='Concurrent readers of the -shm \
+            snapshot while it is updated continuously')
+    shm_parser.add_argument('-r', dest='readers', default=[1, 4, 16], \
+            type=lambda val: [int(i) for i in val.split(',')], \
+            help='Comma separated number of reader processes. \
+            Default: 1,4,16')
+    shm_parser.add_argument('-t', dest='seconds', type=float, default=2, \
+            help='Seconds per measurement. Default: 2')
+    shm_parser.add_argument('-w', dest='period', type=float, default=0.01, \
+            help='Seconds between two updates of the snapshot, 0 for as \
+            fast as possible. Default: 0.01')
+    shm_parser.set_defaults(func=bench_shm)
+    args = parser.parse_args()
+    # Keep the warnings of gaudi_mon off the results
+    gaudi_mon.logger.addHandler(logging.NullHandler())
+    if args.func(args) is False:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#! /usr/bin/python3
+"""Checks of the rollups of gaudi_agg.py on synthetic line protocol. Run
+with python3 -m unittest test_gaudi_agg or python3 -m pytest"""
+
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gaudi_agg
+
+# Start of the window of the lines below, with -window 60
+WINDOW_START = 960000000000
+
+class TestRollups(unittest.TestCase):
+    """Rollups of one window"""
+
+    def aggregate(self, lines):
+        """{(measurement, tags): {field: value}} of the rollups of lines"""
+        output = []
+        self.aggregator = gaudi_agg.Aggregator(60, 0, {}, None,
+                                               output.append)
+        self.aggregator.add_lines(lines)
+        self.aggregator.close_all()
+        rollups = {}
+        for line in output:
+            measurement, tags, fields, ts_ns = gaudi_agg.parse_lp_line(line)
+            if measurement != 'GaudiAggSelf':
+                self.assertEqual(ts_ns, WINDOW_START)
+                rollups[(measurement, tuple(sorted(tags.items())))] = fields
+        return rollups
+
+    def test_stat_prefixes(self):
+        """Rollup fields are prefixed by the stat, max_pwr of the cards is
+        not mistaken for their pwr_max limit"""
+        rollups = self.aggregate([
+            'GaudiMon,host=h1,oam_id=0 pwr=300,pwr_max=600 1000000000000',
+            'GaudiMon,host=h1,oam_id=1 pwr=200,pwr_max=600 1000000000000'])
+        fields = rollups[('GaudiMonRollup', (('by', 'cluster'),))]
+        self.assertEqual(fields, {'series': 2, 'sum_pwr': 500,
+                                  'avg_pwr': 250.0, 'max_pwr': 300})
+
+    def test_no_peer_name(self):
+        """Interfaces of -schema compact have no peer_name tag, they are
+        counted as left out of the peer rollups"""
+        rollups = self.aggregate([
+            'GaudiExtIntf,host=h1,oam_id=0,intf=eth0 cdc=1 1000000000000',
+            'GaudiExtIntf,host=h1,oam_id=0,intf=eth1,peer_name=sw1 cdc=2 '
+            '1000000000000'])
+        tags = (('by', 'peer_name'), ('peer_name', 'sw1'))
+        self.assertEqual(rollups[('GaudiExtIntfRollup', tags)],
+                         {'series': 1, 'sum_cdc': 2, 'avg_cdc': 2.0,
+                          'max_cdc': 2})
+        self.assertEqual(self.aggregator.stats['series_no_peer'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
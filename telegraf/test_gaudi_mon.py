@@ -0,0 +1,1298 @@
+#! /usr/bin/python3
+"""Checks of gaudi_mon.py against synthetic -replay fixtures of
+gaudi_mon_bench.py, and of the ethtool ioctl on a veth pair, so no Gaudi
+hardware is needed. Run with python3 -m unittest test_gaudi_mon or
+python3 -m pytest"""
+
+import sys
+import os
+import gzip
+import io
+import json
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gaudi_mon
+import gaudi_mon_bench
+
+def get_fields(line):
+    """Field names of a line protocol line"""
+    fields = gaudi_mon_bench.LP_SERIES_RE.match(line).end()
+    fields = line[fields + 1:].rsplit(' ', 1)[0]
+    return {field.split('=', 1)[0] for field in fields.split(',')}
+
+class TestStartup(unittest.TestCase):
+    """Startup of the one-shot runs of the exec input"""
+
+    def test_imports(self):
+        """python3 -m gaudi_mon -s imports no slow module"""
+        imports, _ = gaudi_mon_bench.measure_startup(8, 1)
+        slow = [name for name in gaudi_mon_bench.SLOW_IMPORTS
+                if name in imports]
+        self.assertEqual(slow, [])
+
+    @unittest.skipUnless(os.environ.get('GAUDI_MON_BENCH'),
+                         'wall time, set GAUDI_MON_BENCH=1 on a quiet host')
+    def test_budget(self):
+        """python3 -m gaudi_mon -s stays within the budget of
+        gaudi_mon_bench.py startup, best of 20 runs"""
+        imports, times = gaudi_mon_bench.measure_startup(8, 20)
+        self.assertEqual(gaudi_mon_bench.check_startup(
+            imports, times, gaudi_mon_bench.STARTUP_BUDGET), [])
+
+    def test_lazy_imports(self):
+        """json and the slow modules are imported only when used"""
+        modules = ('json',) + gaudi_mon_bench.SLOW_IMPORTS
+        result = subprocess.run([sys.executable, '-c',
+                                 'import sys, gaudi_mon; '
+                                 'print(*sorted(sys.modules))'],
+                                cwd=os.path.dirname(gaudi_mon.__file__),
+                                capture_output=True, check=True)
+        imported = set(result.stdout.decode('utf-8').split())
+        self.assertEqual(imported.intersection(modules), set())
+
+class TestExecd(unittest.TestCase):
+    """-execd cycles on the stdin signal of the Telegraf execd input"""
+
+    def setUp(self):
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as f:
+            json.dump(bundle, f)
+        self.addCleanup(os.remove, f.name)
+        self.proc = subprocess.Popen([sys.executable, gaudi_mon.__file__,
+                                      '-execd', '-s', '-replay', f.name,
+                                      'influxdb-lp'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+        self.addCleanup(self.proc.stdout.close)
+        self.addCleanup(self.proc.kill)
+
+    def read_cycle(self):
+        """Signal a cycle and return its card lines"""
+        self.proc.stdin.write('\n')
+        self.proc.stdin.flush()
+        lines = []
+        # The process stats line ends a cycle
+        while not lines or not lines[-1].startswith('GaudiMonSelf,host='):
+            line = self.proc.stdout.readline()
+            self.assertNotEqual(line, '')
+            lines.append(line)
+        return [line for line in lines if line.startswith('GaudiMon,')]
+
+    def test_cycles(self):
+        """A batch per line read on stdin, exit when stdin is closed"""
+        first = self.read_cycle()
+        self.assertEqual(len(first), 2)
+        second = self.read_cycle()
+        self.assertEqual([line.rsplit(' ', 1)[0] for line in second],
+                         [line.rsplit(' ', 1)[0] for line in first])
+        self.assertNotEqual(second[0].rsplit(' ', 1)[1],
+                            first[0].rsplit(' ', 1)[1])
+        self.proc.stdin.close()
+        self.assertEqual(self.proc.wait(10), 0)
+        self.assertEqual(self.proc.stdout.read(), '')
+
+    def test_sigterm(self):
+        """SIGTERM stops an idle daemon waiting on stdin"""
+        self.assertEqual(len(self.read_cycle()), 2)
+        self.addCleanup(self.proc.stdin.close)
+        self.proc.terminate()
+        self.assertEqual(self.proc.wait(10), 0)
+
+class TestTopology(unittest.TestCase):
+    """Discovery of the cards from sysfs"""
+
+    def setUp(self):
+        self.addCleanup(setattr, gaudi_mon, 'GAUDI_KEY', gaudi_mon.GAUDI_KEY)
+
+    def test_sobm_discovers(self):
+        """-sobm does not replace the cards discovered from sysfs with the
+        static Gaudi2 mapping"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        for path in bundle['files']:
+            if path.endswith('/device_type'):
+                bundle['files'][path] = 'GAUDI3\n'
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-sobm'])
+        self.assertEqual(gaudi_mon.GAUDI_KEY, 'gaudi3')
+        gaudi_dict = gaudi_mon.host_dict['bench']['gaudi3']
+        self.assertEqual({oam_id: oam_attr['bus_id'] for oam_id, oam_attr \
+                          in gaudi_dict.items()},
+                         dict(zip(('0', '1'),
+                                  gaudi_mon_bench.make_bus_ids(2))))
+
+    def test_sobm_without_sysfs(self):
+        """-sobm uses the static mapping if sysfs discovery fails"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        del bundle['dirs'][gaudi_mon.PCIE_STR]
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-sobm'])
+        gaudi_dict = gaudi_mon.host_dict['bench'][gaudi_mon.GAUDI_KEY]
+        self.assertEqual(gaudi_dict['3']['bus_id'], '0000:34:00.0')
+        self.assertEqual(len(gaudi_dict), 8)
+
+class TestSysfsReader(unittest.TestCase):
+    """sysfs attributes read with pread on kept open files"""
+
+    def setUp(self):
+        gaudi_mon.io_fixture = None
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.intf_path = tmp_dir.name + '/net/'
+        os.makedirs(self.intf_path + 'eth0')
+        self.write('eth0', 'address', 'b0:fd:0b:00:00:00\n')
+        self.write('eth0', 'operstate', 'up\n')
+        self.reader = gaudi_mon.SysfsReader()
+        self.addCleanup(self.reader.close_all)
+
+    def write(self, intf, attr, value):
+        """Rewrite an attribute in place, as the kernel regenerates it"""
+        with open(self.intf_path + intf + '/' + attr, 'a+',
+                  encoding='utf-8') as f:
+            f.seek(0)
+            f.truncate()
+            f.write(value)
+
+    def test_reread(self):
+        """A value change is seen through the open file, a missing
+        attribute is None"""
+        attrs = ('address', 'operstate', 'speed')
+        self.assertEqual(self.reader.read_attrs(self.intf_path + 'eth0/',
+                                                attrs),
+                         {'address': 'b0:fd:0b:00:00:00',
+                          'operstate': 'up', 'speed': None})
+        fds = dict(self.reader.fds)
+        self.write('eth0', 'operstate', 'down\n')
+        values = self.reader.read_attrs(self.intf_path + 'eth0/', attrs)
+        self.assertEqual(values['operstate'], 'down')
+        self.assertEqual(self.reader.fds, fds)
+
+    def test_prune(self):
+        """The files of an interface that is gone are closed"""
+        os.makedirs(self.intf_path + 'eth1')
+        self.write('eth1', 'operstate', 'up\n')
+        for intf in ('eth0', 'eth1'):
+            self.reader.read(self.intf_path + intf + '/operstate')
+        self.reader.prune(self.intf_path, ['eth1'])
+        self.assertEqual(list(self.reader.fds),
+                         [self.intf_path + 'eth1/operstate'])
+
+    def test_no_fork(self):
+        """-eist runs no cat or ls, and keeps the sysfs values"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1, n_ext=2)
+        gaudi_mon_bench.setup_replay(bundle, ['-eist'])
+        output = gaudi_mon_bench.run_replay_cycle()
+        lines = [line for line in output.splitlines()
+                 if line.startswith('GaudiExtIntf,')]
+        self.assertEqual(len(lines), 4)
+        self.assertIn('oper_state=up', lines[0])
+        self.assertIn('mac="b0:fd:0b:00:00:00"', lines[0])
+        self.assertIn('GaudiMonSelf,cmd=lldptool', output)
+        self.assertNotIn('GaudiMonSelf,cmd=cat', output)
+        self.assertNotIn('GaudiMonSelf,cmd=ls', output)
+
+class TestHlSmiQuery(unittest.TestCase):
+    """hl-smi -Q support kept across one-shot runs"""
+
+    def setUp(self):
+        gaudi_mon.io_fixture = None
+        gaudi_mon.user_args.clear()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name + '/'
+        # hl-smi without -Q, logs its invocations
+        with open(self.tmp_dir + 'hl-smi', 'w', encoding='utf-8') as f:
+            f.write('#!/bin/sh\necho "$@" >> %scalls\n'
+                    '[ "$1" = -Q ] && exit 2\nexit 0\n' % self.tmp_dir)
+        os.chmod(self.tmp_dir + 'hl-smi', 0o755)
+        patches = (mock.patch.dict(os.environ, {'PATH': self.tmp_dir + \
+                                                os.pathsep + \
+                                                os.environ['PATH']}),
+                   mock.patch.object(gaudi_mon, 'STATE_LOCATION',
+                                     self.tmp_dir))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_once(self):
+        """query_hl_smi of a new one-shot run. Return the hl-smi calls"""
+        gaudi_mon.hl_smi_query_state.update(supported=True, cycle=None,
+                                            loaded=False)
+        self.assertIsNone(gaudi_mon.query_hl_smi('s'))
+        try:
+            with open(self.tmp_dir + 'calls', 'r', encoding='utf-8') as f:
+                calls = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        os.remove(self.tmp_dir + 'calls')
+        return calls
+
+    def test_unsupported_kept(self):
+        """-Q is tried once, not again until hl-smi changes"""
+        self.assertEqual(len(self.run_once()), 1)
+        self.assertEqual(self.run_once(), [])
+        os.utime(self.tmp_dir + 'hl-smi', ns=(0, 0))
+        self.assertEqual(len(self.run_once()), 1)
+
+    def get_status(self, bundle):
+        """status of the card of a -m run"""
+        gaudi_mon_bench.setup_replay(bundle, ['-m'])
+        line = gaudi_mon_bench.run_replay_cycle().splitlines()[0]
+        return line.split(',status=', 1)[1].split(',', 1)[0]
+
+    def test_status(self):
+        """status of -Q, read from the driver, is the Module status of
+        hl-smi -q for a working card, else the state of the driver"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1)
+        self.assertEqual(self.get_status(bundle), '"Active"')
+        status_file = [path for path in bundle['files'] \
+                       if path.endswith('/status')][0]
+        bundle['files'][status_file] = 'in reset\n'
+        self.assertEqual(self.get_status(bundle), '"in reset"')
+        for cmd in list(bundle['cmds']):
+            if cmd.startswith('hl-smi -Q'):
+                del bundle['cmds'][cmd]
+        self.assertEqual(self.get_status(bundle), '"Active"')
+
+class TestInternalIntfStats(unittest.TestCase):
+    """-iis queries the cards in parallel, each with its own deadline"""
+
+    def get_card_stats(self, oam_id):
+        """Self stats of -iis for a card"""
+        for key, fields in gaudi_mon.self_stats.items():
+            tags = dict(key)
+            if tags.get('collector') == 'iis' and \
+               tags.get('oam_id') == str(oam_id):
+                return fields
+        return None
+
+    def test_all_cards(self):
+        """Every card reports its ports and its latency"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(4, 3, 2)
+        gaudi_mon_bench.setup_replay(bundle, ['-iis'])
+        output = gaudi_mon_bench.run_replay_cycle()
+        lines = [line for line in output.splitlines()
+                 if line.startswith('GaudiIntIntf,')]
+        self.assertEqual(len(lines), 4 * 3)
+        for oam_id in range(4):
+            stats = self.get_card_stats(oam_id)
+            self.assertEqual(stats['ports'], 3)
+            self.assertEqual(stats['timed_out'], 0)
+            self.assertIn('latency_ms', stats)
+
+    def test_parallel(self):
+        """Slow cards are waited for together, a card past its deadline is
+        reported as timed out"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(4, 1, 1)
+        gaudi_mon_bench.setup_replay(bundle, ['-iis', '-w', '4', '-cd', '2'])
+        slow_bus_id = gaudi_mon_bench.make_bus_ids(4)[3]
+
+        def get_card_stats(bus_id, deadline):
+            self.assertAlmostEqual(deadline - time.time(), 2, delta=0.5)
+            time.sleep(0.4)
+            return {}, bus_id == slow_bus_id
+
+        with mock.patch.object(gaudi_mon, 'get_card_internal_intf_stats',
+                               get_card_stats):
+            start = time.monotonic()
+            gaudi_mon.get_gaudi_internal_intf_stats()
+            elapsed = time.monotonic() - start
+        self.assertLess(elapsed, 4 * 0.4)
+        self.assertEqual([self.get_card_stats(oam_id)['timed_out']
+                          for oam_id in range(4)], [0, 0, 0, 1])
+        self.assertGreaterEqual(self.get_card_stats(0)['latency_ms'], 400)
+
+    def test_deadline_passed(self):
+        """A card whose deadline has passed is not queried"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1)
+        gaudi_mon_bench.setup_replay(bundle, ['-iis'])
+        with mock.patch.object(gaudi_mon, 'run_cmds') as run_cmds:
+            self.assertEqual(gaudi_mon.get_card_internal_intf_stats(
+                gaudi_mon_bench.make_bus_ids(1)[0], time.time() - 1),
+                ({}, True))
+        run_cmds.assert_not_called()
+
+class TestCounterStore(unittest.TestCase):
+    """Interface counters in arrays with interned schemas"""
+
+    def test_shared_schema(self):
+        """All the ports of all the cards share one schema, and the dict
+        output has the {'meta': {}, 'stats': {}} shape of every port"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 3, 4)
+        gaudi_mon_bench.setup_replay(bundle, ['-iis'])
+        output = gaudi_mon_bench.run_replay_cycle()
+        records = [record for oam_attr in gaudi_mon.host_dict['bench']
+                   [gaudi_mon.GAUDI_KEY].values()
+                   for record in oam_attr['intf_dict']['internal'].values()]
+        self.assertEqual(len(records), 2 * 3)
+        for record in records:
+            self.assertIs(record.schema, records[0].schema)
+            self.assertEqual(record.values.typecode, 'q')
+        exported = json.loads(json.dumps(gaudi_mon.host_dict,
+                                         default=gaudi_mon.host_dict_encoder))
+        port = exported['bench'][gaudi_mon.GAUDI_KEY]['0']['intf_dict'] \
+                       ['internal']['0']
+        self.assertEqual(set(port), {'meta', 'stats'})
+        self.assertEqual(len(port['stats']), 4)
+        line, = [line for line in output.splitlines() if line.startswith(
+                     'GaudiIntIntf,bus_id=0000:33:00.0,intf=0,')]
+        fields = line.split(' ')[1].split(',')
+        self.assertEqual(fields, ['%s=%s' % item
+                                  for item in port['stats'].items()])
+
+    def test_large_values(self):
+        """Counters above 2^63 are kept"""
+        record = gaudi_mon.IntfRecord()
+        record.set_counters(['a', 'b'], [1, 2 ** 63])
+        self.assertEqual(record.values.typecode, 'Q')
+        record.set_counters(['a', 'b'], [-1, 2 ** 64])
+        self.assertEqual(record.to_dict()['stats'], {'a': -1, 'b': 2 ** 64})
+        record.emit_idx = [1]
+        self.assertEqual(record.to_dict()['stats'], {'b': 2 ** 64})
+
+class TestCounterSelection(unittest.TestCase):
+    """-counters profiles and allow and deny globs"""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name + '/'
+        self.bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 4, n_ext=1)
+        cmd = 'hl-smi -n stats -i ' + gaudi_mon_bench.make_bus_ids(1)[0]
+        self.bundle['cmds'][cmd]['stdout'] += \
+            '\n\tpcs local faults: 7\n\tCongestion Q err: 8'
+
+    def get_fields(self, counters):
+        """Field names of GaudiIntIntf and GaudiExtIntf with -counters"""
+        gaudi_mon_bench.setup_replay(self.bundle, ['-iis', '-eis',
+                                                   '-counters', counters])
+        fields = {}
+        for line in gaudi_mon_bench.run_replay_cycle().splitlines():
+            measurement = line.split(',', 1)[0]
+            if measurement in ('GaudiIntIntf', 'GaudiExtIntf'):
+                fields[measurement] = get_fields(line)
+        return fields
+
+    def test_profiles(self):
+        """full drops only the etherStats duplicates, errors-only keeps the
+        error counters"""
+        fields = self.get_fields('full')
+        self.assertEqual(fields['GaudiIntIntf'], {
+            'counter_0', 'counter_1', 'counter_2', 'counter_3',
+            'pcs_local_faults', 'Congestion_Q_err'})
+        self.assertEqual(fields['GaudiExtIntf'], {
+            'counter_0', 'counter_1', 'counter_2', 'counter_3', 'cdc', 'cuc',
+            'mac'})
+        fields = self.get_fields('errors-only')
+        self.assertEqual(fields['GaudiIntIntf'], {'pcs_local_faults',
+                                                  'Congestion_Q_err'})
+
+    def test_config_file(self):
+        """Globs of a measurement in a JSON file are added to the top-level
+        profile, which the other measurement uses as is"""
+        config = self.tmp_dir + 'counters.json'
+        with open(config, 'w', encoding='utf-8') as f:
+            json.dump({'profile': 'errors-only',
+                       'GaudiIntIntf': {'allow': ['counter_[02]', '*FAULT*'],
+                                        'deny': ['counter_2']}}, f)
+        fields = self.get_fields(config)
+        self.assertEqual(fields['GaudiIntIntf'], {'counter_0',
+                                                  'pcs_local_faults',
+                                                  'Congestion_Q_err'})
+        self.assertEqual(fields['GaudiExtIntf'], {'cdc', 'cuc', 'mac'})
+
+    def test_bad_config(self):
+        """An unknown profile or measurement is rejected"""
+        config = self.tmp_dir + 'counters.json'
+        for bad in ({'profile': 'some'}, {'GaudiIntIntf': {'profile': 'x'}},
+                    {'GaudiMon': {}},
+                    {'GaudiExtIntf': {'allow': 'counter_0'}}):
+            with open(config, 'w', encoding='utf-8') as f:
+                json.dump(bad, f)
+            with self.assertRaises(ValueError):
+                gaudi_mon.load_counter_config(config)
+
+class TestHlSmiTable(unittest.TestCase):
+    """Format drift of the hl-smi summary table"""
+
+    def setUp(self):
+        self.table = gaudi_mon_bench.make_hl_smi_fixture(2)
+        self.lines = self.table.split('\n')
+        # Index of the bus line of the first card
+        self.first = [i for i, line in enumerate(self.lines) \
+                      if '0000:33:00.0' in line][0]
+
+    def assert_drift(self, table):
+        """The table is rejected as a whole, and a -s run logs it and
+        prints no card"""
+        with self.assertRaises(gaudi_mon.HlSmiFormatError):
+            gaudi_mon.parse_hl_smi_table(table)
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        for cmd in list(bundle['cmds']):
+            if cmd.startswith('hl-smi -Q'):
+                del bundle['cmds'][cmd]
+        bundle['cmds']['hl-smi']['stdout'] = table
+        gaudi_mon_bench.setup_replay(bundle, ['-s'])
+        with self.assertLogs(gaudi_mon.logger, 'ERROR') as logs:
+            output = gaudi_mon_bench.run_replay_cycle()
+        self.assertTrue(any('Unable to parse hl-smi output' in line \
+                            for line in logs.output))
+        self.assertNotIn('GaudiMon,', output)
+
+    def test_valid(self):
+        """The fixture itself is parsed"""
+        cards = gaudi_mon.parse_hl_smi_table(self.table)
+        self.assertEqual([bus_id for bus_id, _ in cards],
+                         gaudi_mon_bench.make_bus_ids(2))
+        self.assertEqual(cards[1][1]['pwr'], 89)
+
+    def test_truncated(self):
+        """Output cut in the middle of the cards"""
+        self.assert_drift('\n'.join(self.lines[:self.first + 1]))
+
+    def test_stats_line_missing(self):
+        """Last card without its stats line"""
+        del self.lines[self.first + 4]
+        self.assert_drift('\n'.join(self.lines))
+
+    def test_reordered(self):
+        """Stats line before the bus line"""
+        self.lines[self.first], self.lines[self.first + 1] = \
+            self.lines[self.first + 1], self.lines[self.first]
+        self.assert_drift('\n'.join(self.lines))
+
+    def test_extra_column(self):
+        """A new column at the end of every row"""
+        self.assert_drift('\n'.join(line + '    7 |' \
+                                     if line.startswith('| ') else line \
+                                     for line in self.lines))
+
+class TestLineProtocol(unittest.TestCase):
+    """influxdb-lp encoding against the encoder of version 1.00 kept in
+    gaudi_mon_bench.py"""
+
+    TIME_NS = 1700000000123456789
+
+    def setUp(self):
+        gaudi_mon.user_args.clear()
+        gaudi_mon.user_args['schema'] = 'full'
+        gaudi_mon.lp_prefix_cache.clear()
+        gaudi_mon_bench.make_host_dict(2, 2, 3)
+
+    def encode(self):
+        """Lines of write_influxdb_lp for host_dict"""
+        out = io.StringIO()
+        gaudi_mon.write_influxdb_lp(out.write, self_entries=[],
+                                    time_ns=self.TIME_NS)
+        return out.getvalue().splitlines()
+
+    def test_same_as_legacy(self):
+        """Values that need no escaping are encoded as before, with the
+        tags sorted and the timestamp of the cycle in ns. Integers keep
+        their type, without an i suffix"""
+        for attr in gaudi_mon.host_dict['bench']['gaudi2'].values():
+            for record in attr['intf_dict']['external'].values():
+                record.meta['peer_name'] = 'SW-L1-H-12'
+        gaudi_mon.host_dict['bench']['meta']['os_release'] = 'Ubuntu'
+        legacy = gaudi_mon_bench.legacy_influxdb_lp(json.loads(json.dumps(
+            gaudi_mon.host_dict, default=gaudi_mon.host_dict_encoder)))
+        expected = []
+        for line in legacy.splitlines():
+            series, fields = line.split(' ', 1)
+            series = series.split(',')
+            expected.append(','.join(series[:1] + sorted(series[1:])) + \
+                            ' ' + fields + ' ' + str(self.TIME_NS))
+        lines = self.encode()
+        self.assertEqual(sorted(lines), sorted(expected))
+        self.assertIn('un_ecc=0,', lines[0])
+
+    def test_escaping(self):
+        """Spaces, commas and equal signs in the measurement, tags and
+        field keys, quotes and backslashes in string fields"""
+        host_attr = gaudi_mon.host_dict['bench']
+        host_attr['meta'].update({'os_release': 'Ubuntu "22.04" \\ LTS',
+                                  'cpu_model': 'Xeon, 2.1 GHz', 'num_cpu': 8})
+        gaudi_dict = host_attr['gaudi2']
+        del gaudi_dict['1']
+        gaudi_dict['0']['stats'] = {'pwr': 300}
+        gaudi_dict['0']['intf_dict']['internal'].clear()
+        external = gaudi_dict['0']['intf_dict']['external']
+        mac = sorted(external)[0]
+        for other in sorted(external)[1:]:
+            del external[other]
+        record = external[mac]
+        record.meta.update({'peer_name': 'SW L1,H=12', 'peer_intf': 'Eth1/1'})
+        record.set_counters(['rx bytes', 'a=b,c'], [5, 7])
+        self.assertEqual(self.encode(), [
+            'GaudiMon,bus_id=0000:33:00.0,host=bench,oam_id=0 pwr=300,'
+            'os_release="Ubuntu \\"22.04\\" \\\\ LTS",'
+            'cpu_model="Xeon, 2.1 GHz",num_cpu=8 1700000000123456789',
+            'GaudiExtIntf,bus_id=0000:33:00.0,intf=enp0s0d0,oam_id=0,'
+            'oper_speed=100000,oper_state=up,peer_intf=Eth1/1,'
+            'peer_name=SW\\ L1\\,H\\=12 rx\\ bytes=5,a\\=b\\,c=7,'
+            'mac="b0:fd:0b:00:00:00" 1700000000123456789'])
+
+    def test_timestamp(self):
+        """Lines of a cycle carry the cycle time in ns, the precision that
+        influxdb-http declares"""
+        saved = gaudi_mon.cycle_time_ns
+        self.addCleanup(setattr, gaudi_mon, 'cycle_time_ns', saved)
+        gaudi_mon.cycle_time_ns = self.TIME_NS + 1
+        out = io.StringIO()
+        gaudi_mon.write_influxdb_lp(out.write, self_entries=[])
+        self.assertEqual({line.rsplit(' ', 1)[1] \
+                          for line in out.getvalue().splitlines()},
+                         {str(self.TIME_NS + 1)})
+        writer = gaudi_mon.InfluxWriter('http://127.0.0.1:8086', 'telegraf',
+                                        1, 1, '/nonexistent/', 0)
+        self.assertIn('precision=ns', writer.path)
+
+class TestWatcher(unittest.TestCase):
+    """GaudiMonEvent lines of -watch"""
+
+    def setUp(self):
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1, n_ext=2)
+        self.card_path = gaudi_mon.PCIE_STR + '0000:33:00.0/'
+        bundle['dirs'][self.card_path + 'hwmon/'] = ['hwmon0']
+        bundle['dirs'][self.card_path + 'hwmon/hwmon0/'] = ['name',
+                                                            'temp1_input']
+        bundle['files'][self.card_path + 'hwmon/hwmon0/temp1_input'] = \
+            '45000\n'
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-watch', '0.1',
+                                              '-wt', '90'])
+        self.files = gaudi_mon.io_fixture.bundle['files']
+        self.watcher = gaudi_mon.Watcher(0.1, 90, {'0': '0000:33:00.0'})
+        self.addCleanup(self.watcher.reader.close_all)
+
+    def set_file(self, path, value):
+        """Change a sysfs attribute of the card"""
+        self.files[self.card_path + path] = value + '\n'
+
+    def test_events(self):
+        """The first poll is the baseline, then every change is one
+        event"""
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.poll(), [])
+        self.set_file('net/enp0s0d0/operstate', 'down')
+        self.set_file('net/enp0s0d1/carrier_up_count', '5')
+        self.set_file('net/enp0s0d1/carrier_down_count', '4')
+        self.set_file('hwmon/hwmon0/temp1_input', '97500')
+        card = (('oam_id', '0'), ('bus_id', '0000:33:00.0'))
+        self.assertEqual(self.watcher.poll(), [
+            ((('event', 'link_down'),) + card + (('intf', 'enp0s0d0'),),
+             {'old': 'up', 'new': 'down'}),
+            ((('event', 'link_flap'),) + card + (('intf', 'enp0s0d1'),),
+             {'old': 'cdc=3,cuc=4', 'new': 'cdc=4,cuc=5'}),
+            ((('event', 'temperature_high'),) + card,
+             {'old': '90', 'new': '97.5'})])
+        self.assertEqual(self.watcher.poll(), [])
+
+    def test_ecc(self):
+        """An increment of un_ecc read by -s is printed at once"""
+        out = io.StringIO()
+        with mock.patch.object(sys, 'stdout', out):
+            self.watcher.check_cards([('0000:33:00.0', {'un_ecc': 0})], [])
+            self.watcher.check_cards([('0000:33:00.0', {'un_ecc': 2})], [])
+        line, = out.getvalue().splitlines()
+        self.assertRegex(line, r'^GaudiMonEvent,bus_id=0000:33:00.0,'
+                         r'event=ecc_uncorrected,host=bench,oam_id=0 '
+                         r'old="0",new="2" [0-9]+$')
+
+class TestCompactSchema(unittest.TestCase):
+    """-schema compact keeps the series of a link when its state changes"""
+
+    def setUp(self):
+        self.addCleanup(gaudi_mon.intf_meta_state.clear)
+        self.addCleanup(gaudi_mon.intf_meta_state_info.update,
+                        loaded=False, dirty=False)
+        gaudi_mon.intf_meta_state.clear()
+
+    def split_lines(self, output, measurement):
+        """{series: fields} of the lines of a measurement"""
+        series = {}
+        for line in output.splitlines():
+            if line.startswith(measurement + ','):
+                end = gaudi_mon_bench.LP_SERIES_RE.match(line).end()
+                series[line[:end]] = line[end + 1:].rsplit(' ', 1)[0]
+        return series
+
+    def test_link_down(self):
+        """State and neighbor are printed in GaudiIntfMeta when they
+        change, the GaudiExtIntf series stays the same"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1, n_ext=2)
+        gaudi_mon_bench.setup_replay(bundle, ['-eist', '-schema', 'compact'])
+        output = gaudi_mon_bench.run_replay_cycle()
+        ext = self.split_lines(output, 'GaudiExtIntf')
+        self.assertEqual(sorted(ext), [
+            'GaudiExtIntf,bus_id=0000:33:00.0,intf=enp0s0d0,oam_id=0',
+            'GaudiExtIntf,bus_id=0000:33:00.0,intf=enp0s0d1,oam_id=0'])
+        self.assertTrue(all('oper_up=1' in fields for fields in ext.values()))
+        meta = self.split_lines(output, 'GaudiIntfMeta')
+        self.assertEqual(len(meta), 2)
+        self.assertIn('peer_name="SW-L1-H12"', list(meta.values())[0])
+
+        output = gaudi_mon_bench.run_replay_cycle()
+        self.assertEqual(self.split_lines(output, 'GaudiIntfMeta'), {})
+
+        gaudi_mon.io_fixture.bundle['files'][gaudi_mon.PCIE_STR + \
+            '0000:33:00.0/net/enp0s0d1/operstate'] = 'down\n'
+        output = gaudi_mon_bench.run_replay_cycle()
+        new_ext = self.split_lines(output, 'GaudiExtIntf')
+        self.assertEqual(sorted(new_ext), sorted(ext))
+        self.assertIn('oper_up=0', new_ext[sorted(ext)[1]])
+        (series, fields), = self.split_lines(output,
+                                             'GaudiIntfMeta').items()
+        self.assertIn('intf=enp0s0d1', series)
+        self.assertIn('oper_state="down"', fields)
+
+class TestScheduler(unittest.TestCase):
+    """Per-job intervals, skips and overruns of -sched"""
+
+    def test_slow_job(self):
+        """A job slower than its interval is counted as an overrun and its
+        runs due meanwhile are skipped, while the other jobs keep their
+        interval"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1, n_ext=1)
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-eis', '-sched',
+                                              '-intervals', 's=0.1,eis=0.2',
+                                              '-jitter', '0'])
+        self.addCleanup(gaudi_mon.daemon_state.update, stop=False)
+        runs = {'s': [], 'eis': []}
+
+        def collect(job, host_attr):
+            runs[job.name].append(time.monotonic())
+            if job.name == 'eis':
+                time.sleep(0.5)
+
+        with mock.patch.object(gaudi_mon.SchedJob, 'collect', collect), \
+             mock.patch.object(sys, 'stdout', io.StringIO()):
+            thread = threading.Thread(target=gaudi_mon.run_scheduler)
+            thread.start()
+            time.sleep(1.2)
+            gaudi_mon.daemon_state['stop'] = True
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+        stats = {dict(key)['collector']: fields for key, fields \
+                 in gaudi_mon.self_stats.items() \
+                 if dict(key).get('collector') in runs}
+        self.assertIn(len(runs['eis']), (2, 3))
+        self.assertEqual(stats['eis']['runs'], len(runs['eis']))
+        self.assertEqual(stats['eis']['overruns'], len(runs['eis']))
+        self.assertGreaterEqual(stats['eis']['skips'], 2)
+        self.assertGreaterEqual(len(runs['s']), 10)
+        self.assertEqual(stats['s']['overruns'], 0)
+        self.assertEqual(stats['s']['skips'], 0)
+        gaps = [b - a for a, b in zip(runs['s'], runs['s'][1:])]
+        # eis takes 0.5 s, a gap that long would mean s waited for it
+        self.assertLess(max(gaps), 0.35)
+
+class TestSelfStats(unittest.TestCase):
+    """GaudiMonSelf overhead of the collectors, commands and process"""
+
+    def test_one_shot(self):
+        """A one-shot run reports every collector, command and the cycle,
+        and -profile writes the dumps of the cycle"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        fixture = os.path.join(tmp_dir.name, 'fixture.json')
+        with open(fixture, 'w', encoding='utf-8') as f:
+            json.dump(bundle, f)
+        profile_dir = os.path.join(tmp_dir.name, 'profile')
+        result = subprocess.run([sys.executable, gaudi_mon.__file__, '-s',
+                                 '-iis', '-profile', profile_dir, '-replay',
+                                 fixture, 'influxdb-lp'],
+                                capture_output=True, check=True,
+                                universal_newlines=True)
+        series = {}
+        for line in result.stdout.splitlines():
+            end = gaudi_mon_bench.LP_SERIES_RE.match(line).end()
+            series[line[:end]] = line[end + 1:].rsplit(' ', 1)[0]
+        self.assertIn('duration_ms=',
+                      series['GaudiMonSelf,collector=s,host=bench'])
+        self.assertIn('count=2,', series['GaudiMonSelf,cmd=hl-smi\\ -n\\ '
+                                         'stats,host=bench'])
+        self.assertIn('ports=1', series['GaudiMonSelf,bus_id=0000:34:00.0,'
+                                        'collector=iis,host=bench,oam_id=1'])
+        self.assertRegex(series['GaudiMonSelf,host=bench'],
+                         r'^cycle_ms=[0-9.]+,max_rss_kb=[0-9]+,')
+        # A one-shot run profiles its whole cycle, named by its pid
+        dumps = sorted(os.listdir(profile_dir))
+        prefix = 'gaudi_mon_s_cycle_' + dumps[0].split('_')[4].split('.')[0]
+        self.assertEqual(dumps, [prefix + '.prof', prefix + '_cprofile.txt',
+                                 prefix + '_tracemalloc.txt'])
+
+    def test_failures(self):
+        """A command that fails is counted by its name without the bus-id"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        bus_id = gaudi_mon_bench.make_bus_ids(2)[0]
+        cmd = 'hl-smi -n stats -i ' + bus_id
+        bundle['cmds'][cmd] = dict(bundle['cmds'][cmd], returncode=1)
+        gaudi_mon_bench.setup_replay(bundle, ['-iis'])
+        gaudi_mon.cmd_stats.clear()
+        gaudi_mon_bench.run_replay_cycle()
+        stats = gaudi_mon.cmd_stats['hl-smi -n stats']
+        self.assertEqual((stats['count'], stats['failures'],
+                          stats['timeouts']), (2, 1, 0))
+        self.assertEqual(gaudi_mon.self_stats[(('cmd', 'hl-smi -n stats'),)],
+                         stats)
+
+class TestRecordReplay(unittest.TestCase):
+    """A run recorded with -record is replayed with -replay"""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name + '/'
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        # The sysfs tree of the cards, under a temporary PCIE_STR
+        pcie_str = self.tmp_dir + 'habanalabs/'
+        for path, content in bundle['files'].items():
+            if path.startswith(gaudi_mon.PCIE_STR):
+                path = pcie_str + path[len(gaudi_mon.PCIE_STR):]
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+        # hl-smi that prints the card stats of the bundle
+        os.mkdir(self.tmp_dir + 'bin')
+        query = [cmd for cmd in bundle['cmds']
+                 if cmd.startswith('hl-smi -Q bus_id,temperature') and \
+                 cmd.endswith('ecc.errors.uncorrected.volatile.total '
+                              '-f csv,noheader')][0]
+        with open(self.tmp_dir + 'query', 'w', encoding='utf-8') as f:
+            f.write(bundle['cmds'][query]['stdout'])
+        with open(self.tmp_dir + 'bin/hl-smi', 'w', encoding='utf-8') as f:
+            f.write('#!/bin/sh\ncat %squery\n' % self.tmp_dir)
+        os.chmod(self.tmp_dir + 'bin/hl-smi', 0o755)
+        patches = (mock.patch.object(gaudi_mon, 'PCIE_STR', pcie_str),
+                   mock.patch.dict(os.environ, {'PATH': self.tmp_dir + \
+                                                'bin' + os.pathsep + \
+                                                os.environ['PATH']}))
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(setattr, gaudi_mon, 'io_fixture', None)
+
+    def test_round_trip(self):
+        """The replay of a recording prints the recorded values, without
+        hl-smi"""
+        fixture = self.tmp_dir + 'fixture.json'
+        saved_argv = sys.argv
+        sys.argv = ['gaudi_mon.py', '-s', '-record', fixture, 'influxdb-lp']
+        try:
+            gaudi_mon.user_args.clear()
+            gaudi_mon.parse_cmdline_arguments()
+        finally:
+            sys.argv = saved_argv
+        gaudi_mon.setup_io_fixture()
+        gaudi_mon.host_dict.clear()
+        gaudi_mon.hl_smi_query_state.update(supported=True, cycle=None,
+                                            loaded=False)
+        gaudi_mon.get_gaudi_module_id_and_bus_id()
+        recorded = gaudi_mon_bench.run_replay_cycle()
+        gaudi_mon.io_fixture.save()
+        self.assertEqual(recorded.count('GaudiMon,bus_id='), 2)
+
+        os.remove(self.tmp_dir + 'bin/hl-smi')
+        shutil.rmtree(gaudi_mon.PCIE_STR)
+        with open(fixture, 'r', encoding='utf-8') as f:
+            bundle = json.load(f)
+        gaudi_mon_bench.setup_replay(bundle, ['-s'])
+        replayed = gaudi_mon_bench.run_replay_cycle()
+
+        def get_cards(output):
+            return [line.rsplit(' ', 1)[0] for line in output.splitlines()
+                    if line.startswith('GaudiMon,')]
+        self.assertEqual(get_cards(replayed), get_cards(recorded))
+
+class TestPrometheus(unittest.TestCase):
+    """/metrics served from the exposition of the last collector runs"""
+
+    def setUp(self):
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 2, 2)
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-iis'])
+        gaudi_mon.user_args['output_format'] = 'prometheus'
+        self.addCleanup(gaudi_mon.prom_snapshot.update, body=b'', time=0)
+        from http.server import ThreadingHTTPServer
+        server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                     gaudi_mon.make_prom_handler())
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%s' % server.server_address[1]
+
+    def scrape(self, path='/metrics'):
+        """Return (status, body) of a GET"""
+        import urllib.request
+        import urllib.error
+        try:
+            with urllib.request.urlopen(self.url + path, timeout=5) as resp:
+                return resp.status, resp.read().decode('utf-8')
+        except urllib.error.HTTPError as e:
+            return e.code, ''
+
+    def test_scrape(self):
+        """Scrapes return the same exposition and run no collector, a
+        collector run replaces its own samples"""
+        for name in ('s', 'iis'):
+            gaudi_mon.SchedJob(name, 10, 0, name == 's').run()
+        status, body = self.scrape()
+        self.assertEqual(status, 200)
+        self.assertIn('# TYPE gaudimon_temperature untyped\n'
+                      'gaudimon_temperature{host="bench",oam_id="0",'
+                      'bus_id="0000:33:00.0"} 0\n', body)
+        self.assertEqual(body.count('gaudimon_int_intf_up{'), 2 * 2)
+        names = [line.split(' ')[2] for line in body.splitlines()
+                 if line.startswith('# TYPE ')]
+        self.assertEqual(names, sorted(set(names)))
+        counts = {name: stats['count']
+                  for name, stats in gaudi_mon.cmd_stats.items()}
+        self.assertEqual(self.scrape(), (200, body))
+        self.assertEqual({name: stats['count'] for name, stats
+                          in gaudi_mon.cmd_stats.items()}, counts)
+
+        gaudi_mon.SchedJob('s', 10, 0, True).run()
+        status, new_body = self.scrape()
+        self.assertNotEqual(new_body, body)
+        self.assertEqual(new_body.count('gaudimon_int_intf_up{'), 2 * 2)
+
+    def test_not_found(self):
+        """Only /metrics is served"""
+        self.assertEqual(self.scrape('/'), (404, ''))
+
+class TestCounterRates(unittest.TestCase):
+    """Rates of the interface counters across runs"""
+
+    def test_eist_and_eis_alternately(self):
+        """-eist and -eis exec inputs side by side keep their own samples,
+        so the ethtool counters of -eis still get rates"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 2, 3, n_ext=1)
+        gaudi_mon_bench.setup_replay(bundle, ['-eis', '-rates'])
+        user_args = gaudi_mon.user_args
+        self.assertEqual(gaudi_mon.get_run_suffix(), '_eis')
+        for ext_intf_status in (False, True, False, True, False):
+            user_args['ext_intf_status'] = ext_intf_status
+            output = gaudi_mon_bench.run_replay_cycle()
+        self.assertEqual(gaudi_mon.get_run_suffix(), '_eis')
+        rate_lines = [line for line in output.splitlines() \
+                      if line.startswith('GaudiExtIntfRate,')]
+        self.assertEqual(len(rate_lines), 1)
+        self.assertIn('counter_0', get_fields(rate_lines[0]))
+        user_args['ext_intf_status'] = True
+        self.assertEqual(gaudi_mon.get_run_suffix(), '_eist')
+
+class TestLldpNeighbor(unittest.TestCase):
+    """LLDP neighbor cache of -eis and -eist"""
+
+    def test_change_after_lldptool_failure(self):
+        """A failed lldptool run keeps the last known neighbor, so a
+        re-cable seen by the next run is still reported"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1, n_ext=1)
+        gaudi_mon_bench.setup_replay(bundle, ['-eist', '-lt', '0'])
+        cmds = gaudi_mon.io_fixture.bundle['cmds']
+        cmd = [cmd for cmd in cmds if 'lldptool' in cmd][0]
+        recorded = dict(cmds[cmd])
+        output = gaudi_mon_bench.run_replay_cycle()
+        self.assertIn('peer_intf=Eth1/1/1', output)
+        cmds[cmd] = dict(recorded, returncode=1)
+        output = gaudi_mon_bench.run_replay_cycle()
+        self.assertNotIn('lldp_neighbor_change', output)
+        cmds[cmd] = dict(recorded,
+                         stdout=gaudi_mon_bench.make_lldp_fixture(4))
+        output = gaudi_mon_bench.run_replay_cycle()
+        self.assertIn('peer_intf=Eth1/5/1', output)
+        self.assertIn('lldp_neighbor_change', output)
+
+    def test_refresh(self):
+        """lldptool runs again only for an interface whose carrier counts
+        have changed, or once the -lt TTL has passed"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(1, 1, 1, n_ext=2)
+        gaudi_mon_bench.setup_replay(bundle, ['-eist', '-lt', '3600'])
+
+        def count_lldptool():
+            output = gaudi_mon_bench.run_replay_cycle()
+            self.assertEqual(output.count('peer_intf=Eth1/'), 2)
+            return gaudi_mon.cmd_stats['lldptool -t -n']['count']
+
+        count = count_lldptool()
+        self.assertEqual(count_lldptool(), count)
+        files = gaudi_mon.io_fixture.bundle['files']
+        files[gaudi_mon.PCIE_STR + '0000:33:00.0/net/enp0s0d1/'
+              'carrier_up_count'] = '5\n'
+        self.assertEqual(count_lldptool(), count + 1)
+        self.assertEqual(count_lldptool(), count + 1)
+        for entry in gaudi_mon.lldp_cache.values():
+            entry[0] = entry[0] - 3600
+        self.assertEqual(count_lldptool(), count + 3)
+
+class TestRunCmds(unittest.TestCase):
+    """Timeout, process group kill and concurrency of run_cmds()"""
+
+    def setUp(self):
+        gaudi_mon.io_fixture = None
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def make_script(self, name, body):
+        """Path of a shell script, commands are split on spaces"""
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        return path
+
+    def assert_gone(self, pid):
+        """pid has exited, a zombie not yet reaped by init is gone too"""
+        for _ in range(50):
+            try:
+                with open('/proc/%d/stat' % pid, 'r', encoding='utf-8') as f:
+                    if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                        return
+            except FileNotFoundError:
+                return
+            time.sleep(0.02)
+        self.fail('pid %d still running' % pid)
+
+    def run_timed(self, cmds, timeout, limit=8):
+        """(results, wall time) of run_cmds"""
+        start = time.monotonic()
+        results = gaudi_mon.run_cmds(cmds, timeout=timeout, limit=limit)
+        return results, time.monotonic() - start
+
+    def test_timeout_kills_group(self):
+        """A command over -ct is killed with the children it started, in
+        the single command and the concurrent paths"""
+        for n_cmds in (1, 2):
+            pid_file = os.path.join(self.tmp_dir, 'pid%d' % n_cmds)
+            script = self.make_script('hang.sh', 'sleep 100 &\n'
+                                      'echo $! > ' + pid_file + '\nwait\n')
+            results, wall = self.run_timed(['sh ' + script] * n_cmds, 0.5)
+            self.assertLess(wall, 0.5 + 0.5)
+            for result in results:
+                self.assertTrue(result.timed_out)
+                self.assertFalse(result.ok)
+            with open(pid_file, 'r', encoding='utf-8') as f:
+                self.assert_gone(int(f.read()))
+
+    def test_unkillable(self):
+        """A command that can not be killed, like sudo run by a user, is
+        given up after KILL_GRACE and reported as timed out"""
+        pgids = []
+        def killpg(pgid, sig):
+            pgids.append(pgid)
+            raise PermissionError(1, 'Operation not permitted')
+        real_killpg = os.killpg
+        def cleanup():
+            for pgid in pgids:
+                try:
+                    real_killpg(pgid, 9)
+                except ProcessLookupError:
+                    pass
+        self.addCleanup(cleanup)
+        for cmds in (['sleep 100'], ['sleep 100', 'true']):
+            with mock.patch.object(gaudi_mon.os, 'killpg', killpg):
+                results, wall = self.run_timed(cmds, 0.5)
+            self.assertLess(wall, 0.5 + gaudi_mon.KILL_GRACE + 0.5)
+            self.assertTrue(results[0].timed_out)
+            self.assertIsNone(results[0].returncode)
+        self.assertEqual(len(pgids), 2)
+
+    def test_concurrency(self):
+        """At most -cc commands run at a time, the output of every command
+        is kept in order"""
+        cmds = ['echo %d' % i for i in range(4)]
+        cmds = [cmd for i in range(4) for cmd in ('sleep 0.3', cmds[i])]
+        results, wall = self.run_timed(cmds[::2], 5, limit=2)
+        self.assertGreaterEqual(wall, 0.6)
+        self.assertLess(wall, 0.9)
+        results, wall = self.run_timed(cmds[::2], 5, limit=4)
+        self.assertLess(wall, 0.6)
+        results, _ = self.run_timed(cmds[1::2], 5, limit=2)
+        self.assertEqual([result.output() for result in results],
+                         ['0', '1', '2', '3'])
+
+class TestStreamingParsers(unittest.TestCase):
+    """hl-smi -n stats and ethtool -S parsed while the commands run"""
+
+    def setUp(self):
+        gaudi_mon.io_fixture = None
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name + '/'
+        self.counter_filter = gaudi_mon.CounterFilter(
+            deny=gaudi_mon.ETHER_STATS_DUPLICATES)
+
+    def test_same_as_buffered(self):
+        """Lines cut across chunks give the ports of the buffered parsing,
+        and the output is not kept"""
+        stats = gaudi_mon_bench.make_hl_smi_stats_fixture(8, 40, True)
+        with open(self.tmp_dir + 'stats', 'w', encoding='utf-8') as f:
+            f.write(stats)
+        cmd = 'cat ' + self.tmp_dir + 'stats'
+        expected = gaudi_mon_bench.legacy_parse_internal_stats(
+            gaudi_mon.run_cmds([cmd])[0].output(), self.counter_filter)
+        self.assertEqual(len(expected), 8)
+        # Two commands, so that the asyncio reader is used
+        parsers = [gaudi_mon.InternalStatsParser(self.counter_filter)
+                   for _ in range(2)]
+        with mock.patch.object(gaudi_mon, 'STREAM_CHUNK', 7):
+            results = gaudi_mon.run_cmds([cmd, cmd], parsers=parsers)
+        for result, parser in zip(results, parsers):
+            self.assertTrue(result.ok)
+            self.assertEqual(result.stdout, b'')
+            self.assertEqual(result.stdout_bytes, len(stats.encode('utf-8')))
+            self.assertEqual(parser.ports, expected)
+
+    def test_while_running(self):
+        """Lines are parsed as they are written"""
+        with open(self.tmp_dir + 'ethtool', 'w', encoding='utf-8') as f:
+            f.write('#!/bin/sh\necho "NIC statistics:"\n'
+                    'echo "     rx_packets: 56529"\nsleep 1\n'
+                    'echo "     etherStatsOctets: 1"\n'
+                    'echo "     tx_bytes: 17685919"\n')
+        os.chmod(self.tmp_dir + 'ethtool', 0o755)
+        parser = gaudi_mon.EthtoolStatsParser(self.counter_filter)
+        fed = []
+
+        def feed(line):
+            fed.append((time.monotonic(), line))
+            gaudi_mon.EthtoolStatsParser.feed(parser, line)
+
+        parser.feed = feed
+        start = time.monotonic()
+        result, = gaudi_mon.run_cmds([self.tmp_dir + 'ethtool'],
+                                     parsers=[parser])
+        self.assertTrue(result.ok)
+        self.assertLess(fed[1][0] - start, 0.9)
+        self.assertEqual(fed[1][1], '     rx_packets: 56529')
+        self.assertGreaterEqual(fed[-1][0] - start, 1)
+        self.assertEqual((parser.names, parser.values),
+                         (['rx_packets', 'tx_bytes'], [56529, 17685919]))
+
+class InfluxHandler(BaseHTTPRequestHandler):
+    """/write of InfluxDB, answers with the status of the server and keeps
+    the lines it accepts"""
+
+    def do_POST(self):
+        """One batch"""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.status == 204:
+            self.server.batches.append(gzip.decompress(body).decode('utf-8'))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        """Quiet"""
+
+class TestInfluxWriter(unittest.TestCase):
+    """Spool and replay of influxdb-http against a local server"""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.spool_dir = tmp_dir.name + '/spool/'
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.writer = gaudi_mon.InfluxWriter(
+            'http://127.0.0.1:%d' % self.port, 'telegraf', 1, 10,
+            self.spool_dir, 1000000, timeout=2)
+        self.addCleanup(self.writer.close)
+        self.server = None
+
+    def start_server(self, status):
+        """Serve /write on the port of the writer"""
+        self.server = HTTPServer(('127.0.0.1', self.port), InfluxHandler)
+        self.server.status = status
+        self.server.batches = []
+        self.addCleanup(self.server.server_close)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+
+    def test_spool_and_replay(self):
+        """Batches that InfluxDB refuses or fails (5xx) are spooled, then
+        replayed in order and removed once it is back"""
+        self.writer.write('m v=1i 1\n')
+        self.start_server(503)
+        self.writer.write('m v=2i 2\n')
+        self.writer.write('m v=3i 3\n')
+        self.assertEqual(len(self.writer.spool_files()), 3)
+        self.assertEqual(self.writer.stats['failures'], 3)
+        self.server.status = 204
+        self.writer.write('m v=4i 4\n')
+        self.assertEqual(self.server.batches, ['m v=4i 4\n', 'm v=1i 1\n',
+                                               'm v=2i 2\n', 'm v=3i 3\n'])
+        self.assertEqual(self.writer.spool_files(), [])
+        self.assertEqual(self.writer.stats['lines_sent'], 4)
+
+class TestCardSampler(unittest.TestCase):
+    """-ss rings of the card stats"""
+
+    def test_stdin_window(self):
+        """With signal = "STDIN" the window is unknown, a window longer than
+        the -s interval keeps all its samples and reports its length"""
+        sampler = gaudi_mon.CardSampler(1)
+        n_samples = gaudi_mon.COLLECTOR_INTERVALS['s'] * 4
+        for i in range(n_samples):
+            sampler.add([('0000:19:00.0', {'pwr': str(100 + i)})])
+        sampler.window_start = sampler.window_start - n_samples
+        (bus_id, stats), = sampler.summarize()
+        self.assertEqual(bus_id, '0000:19:00.0')
+        self.assertEqual(stats['samples'], n_samples)
+        self.assertEqual(stats['min_pwr'], 100)
+        self.assertGreaterEqual(stats['window_s'], n_samples)
+
+    def test_window_summary(self):
+        """-s prints the summary of the samples of the window, taken from
+        a ring of fixed size, and runs no hl-smi of its own"""
+        bundle = gaudi_mon_bench.make_fixture_bundle(2, 1, 1)
+        gaudi_mon_bench.setup_replay(bundle, ['-s', '-ss', '0.25'])
+        sampler = gaudi_mon.CardSampler(0.25, window=1)
+        self.assertEqual(sampler.size, 6)
+        self.addCleanup(setattr, gaudi_mon, 'card_sampler', None)
+        gaudi_mon.card_sampler = sampler
+        cmds = gaudi_mon.io_fixture.bundle['cmds']
+        query = [cmd for cmd in cmds if cmd.startswith('hl-smi -Q') and \
+                 cmd.endswith('volatile.total -f csv,noheader')][0]
+        # pwr of the first card is 100 .. 109, the first 4 samples fall out
+        # of the ring
+        recorded = cmds[query]
+        for pwr in range(100, 110):
+            cmds[query] = dict(recorded, stdout=recorded['stdout'].replace(
+                '0000:33:00.0, 0 C, 0 %, 0 W',
+                '0000:33:00.0, 0 C, 0 %, ' + str(pwr) + ' W'))
+            sampler.sample()
+        calls = gaudi_mon.cmd_stats['hl-smi -Q']['count']
+        output = gaudi_mon_bench.run_replay_cycle()
+        self.assertEqual(gaudi_mon.cmd_stats['hl-smi -Q']['count'], calls)
+        line, = [line for line in output.splitlines()
+                 if line.startswith('GaudiMon,bus_id=0000:33:00.0,')]
+        fields = dict(field.split('=') for field in
+                      line.split(' ')[1].split(','))
+        self.assertEqual((fields['pwr'], fields['min_pwr'], fields['max_pwr'],
+                          fields['mean_pwr'], fields['p95_pwr'],
+                          fields['samples']),
+                         ('109', '104', '109', '106.5', '109', '6'))
+        self.assertEqual(sampler.summarize(), [])
+
+class FailingMap(bytearray):
+    """Map of the -shm file where the copy of the snapshot fails"""
+
+    def __setitem__(self, key, val):
+        raise OSError('copy failed')
+
+    def close(self):
+        """Nothing to unmap"""
+
+class TestShmSnapshot(unittest.TestCase):
+    """-shm snapshot of the card stats"""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'gaudi_mon')
+        self.writer = gaudi_mon.ShmSnapshotWriter(self.path)
+        self.addCleanup(self.writer.close)
+        self.reader = gaudi_mon.ShmSnapshotReader(self.path)
+        self.addCleanup(self.reader.close)
+
+    def test_failed_card(self):
+        """A card without module id is published under its NA- key, after
+        the other cards"""
+        gaudi_mon.user_args['shm'] = self.path
+        gaudi_mon.shm_writer = self.writer
+        self.addCleanup(setattr, gaudi_mon, 'shm_writer', None)
+        host_attr = {gaudi_mon.GAUDI_KEY: {
+            'NA-0000:4d:00.0': {'bus_id': '0000:4d:00.0', 'stats': {}},
+            '10': {'bus_id': '0000:b3:00.0', 'stats': {'util': '7'}},
+            '2': {'bus_id': '0000:19:00.0', 'stats': {'util': '3'}}}}
+        gaudi_mon.publish_shm_snapshot(host_attr)
+        cards = self.reader.read()['cards']
+        self.assertEqual(list(cards), ['2', '10', 'NA-0000:4d:00.0'])
+        self.assertEqual(cards['10'], {'bus_id': '0000:b3:00.0', 'util': 7})
+        self.assertEqual(cards['NA-0000:4d:00.0']['bus_id'], '0000:4d:00.0')
+
+    def test_failed_publish(self):
+        """A publish that fails half way leaves seq even, so readers do
+        not spin"""
+        cards = [('0', '0000:19:00.0', {'util': '3'})]
+        self.writer.publish(cards, 1)
+        self.writer.mm.close()
+        self.writer.mm = FailingMap(self.writer.size)
+        with self.assertRaises(OSError):
+            self.writer.publish(cards, 2)
+        self.assertEqual(self.writer.seq % 2, 0)
+        self.assertEqual(gaudi_mon.SHM_SEQ.unpack_from(
+            self.writer.mm, gaudi_mon.SHM_SEQ_OFFSET)[0], self.writer.seq)
+
+    def test_bad_value(self):
+        """A stat that is not a number keeps the previous snapshot"""
+        self.writer.publish([('0', '0000:19:00.0', {'util': '3'})], 1)
+        with self.assertRaises(ValueError):
+            self.writer.publish([('0', '0000:19:00.0', {'util': 'N/A'})], 2)
+        snapshot = self.reader.read()
+        self.assertEqual(snapshot['time_ns'], 1)
+        self.assertEqual(snapshot['cards']['0']['util'], 3)
+
+class TestEthtoolStatsReader(unittest.TestCase):
+    """SIOCETHTOOL reader on a veth pair. Skipped if it can not be created,
+    which needs root"""
+
+    def setUp(self):
+        gaudi_mon.io_fixture = None
+        self.intf = 'gmt%d' % os.getpid()
+        self.peer = self.intf + 'p'
+        try:
+            result = subprocess.run(['ip', 'link', 'add', self.intf, 'type',
+                                     'veth', 'peer', 'name', self.peer],
+                                    capture_output=True, check=False)
+        except OSError as e:
+            self.skipTest('ip: ' + str(e))
+        if result.returncode != 0:
+            self.skipTest('Unable to create veth: ' + \
+                          result.stderr.decode('utf-8', 'replace').strip())
+
+    def tearDown(self):
+        subprocess.run(['ip', 'link', 'del', self.intf], capture_output=True,
+                       check=False)
+
+    def read_stats(self):
+        """{name: value} of the ioctl reader"""
+        counters = gaudi_mon.EthtoolStatsReader().read_stats(
+            self.intf, gaudi_mon.CounterFilter())
+        self.assertIsNotNone(counters)
+        return dict(zip(*counters))
+
+    def test_peer_ifindex(self):
+        """Names and values line up, veth reports the ifindex of its peer"""
+        stats = self.read_stats()
+        self.assertEqual(stats['peer_ifindex'],
+                         socket.if_nametoindex(self.peer))
+
+    def test_same_as_ethtool(self):
+        """Same counters as ethtool -S"""
+        if shutil.which('ethtool') is None:
+            self.skipTest('ethtool not installed')
+        parser = gaudi_mon.EthtoolStatsParser(gaudi_mon.CounterFilter())
+        result = subprocess.run(['ethtool', '-S', self.intf],
+                                capture_output=True, check=True)
+        for line in result.stdout.decode('utf-8').splitlines():
+            parser.feed(line)
+        self.assertEqual(self.read_stats(),
+                         dict(zip(parser.names, parser.values)))
+
+if __name__ == '__main__':
+    unittest.main()